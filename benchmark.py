@@ -0,0 +1,369 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import shutil
+import threading
+import hashlib
+import subprocess
+import base64
+import http.client
+import http.server
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import chat_server
+
+# Local stand-in for the GitHub contents API. Files live in memory; latency
+# is added to every request and a fixed-window quota is enforced with the
+# same headers and status codes GitHub uses.
+class FakeGitHubAPI(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, rate_limit=None, rate_window=60.0):
+        super().__init__(('127.0.0.1', 0), FakeGitHubHandler)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.files = {}
+        self.requests = 0
+        self.rate_limited = 0
+        self.bytes_received = 0
+        self._window_start = time.time()
+        self._window_used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def take_quota(self):
+        # Returns (allowed, rate limit headers)
+        with self._lock:
+            self.requests += 1
+            now = time.time()
+            if now - self._window_start >= self.rate_window:
+                self._window_start, self._window_used = now, 0
+            reset_at = int(self._window_start + self.rate_window)
+            if self.rate_limit is None:
+                return True, {}
+            allowed = self._window_used < self.rate_limit
+            if allowed:
+                self._window_used += 1
+            else:
+                self.rate_limited += 1
+            return allowed, {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(self.rate_limit - self._window_used),
+                'X-RateLimit-Reset': str(reset_at)
+            }
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload, headers):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start(self):
+        time.sleep(self.server.latency)
+        allowed, headers = self.server.take_quota()
+        if not allowed:
+            self._reply(403, {'message': 'API rate limit exceeded'}, headers)
+        return allowed, headers
+
+    def do_GET(self):
+        allowed, headers = self._start()
+        if not allowed:
+            return
+        stored = self.server.files.get(self.path)
+        if stored is None:
+            self._reply(404, {'message': 'Not Found'}, headers)
+            return
+        etag = f'"{stored["sha"]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        headers['ETag'] = etag
+        self._reply(200, stored, headers)
+
+    def do_PUT(self):
+        length = int(self.headers['Content-Length'])
+        payload = json.loads(self.rfile.read(length))
+        self.server.bytes_received += length
+        allowed, headers = self._start()
+        if not allowed:
+            return
+        stored = self.server.files.get(self.path)
+        if stored is not None and 'sha' not in payload:
+            self._reply(422, {'message': "Invalid request. \"sha\" wasn't supplied."}, headers)
+            return
+        if stored is not None and payload['sha'] != stored['sha']:
+            self._reply(409, {'message': 'sha does not match'}, headers)
+            return
+        content = base64.b64decode(payload['content'])
+        sha = hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+        self.server.files[self.path] = {'sha': sha, 'content': payload['content']}
+        self._reply(201 if stored is None else 200, {'content': {'sha': sha}}, headers)
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+# One simulated client: a keep-alive connection issuing a weighted mix of
+# posts, full page reads and incremental cursor polls
+class ClientWorker(threading.Thread):
+    def __init__(self, port, mix, deadline, seed):
+        super().__init__(daemon=True)
+        self.port = port
+        self.operations = [name for name, weight in mix.items() for _ in range(weight)]
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.latencies = {name: [] for name in mix}
+        self.errors = {name: 0 for name in mix}
+        self.cursor = 0
+        self.etag = None
+
+    def run(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        while time.monotonic() < self.deadline:
+            operation = self.random.choice(self.operations)
+            started = time.perf_counter()
+            try:
+                ok = getattr(self, operation)(conn)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+                ok = False
+            if ok:
+                self.latencies[operation].append(time.perf_counter() - started)
+            else:
+                self.errors[operation] += 1
+        conn.close()
+
+    def post(self, conn):
+        body = json.dumps({'content': f'benchmark message {self.random.random()}', 'repository': 'bench'})
+        conn.request('POST', '/messages', body=body, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        return response.status == 201
+
+    def get(self, conn):
+        conn.request('GET', '/messages?limit=50')
+        response = conn.getresponse()
+        response.read()
+        return response.status == 200
+
+    def poll(self, conn):
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        conn.request('GET', f'/messages?since_id={self.cursor}&limit=100', headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            self.cursor = int(response.getheader('X-Next-Cursor', self.cursor))
+            self.etag = response.getheader('ETag')
+        return response.status in (200, 304)
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('post', 'get', 'poll'):
+            raise argparse.ArgumentTypeError(f'unknown operation {name!r}')
+        mix[name] = int(weight or 1)
+    return mix
+
+def run_benchmark(duration=10.0, concurrency=8, mix=None, mode='threaded', workers=16,
+                  github_latency=0.05, github_rate_limit=None, seed=0, sync_backend='github',
+                  git_push_interval=1.0):
+    mix = mix or {'post': 1, 'get': 2, 'poll': 7}
+    fake_github = FakeGitHubAPI(github_latency, github_rate_limit)
+    threading.Thread(target=fake_github.serve_forever, daemon=True).start()
+
+    temp_dir = tempfile.mkdtemp()
+    # With the git backend, commits go to a local mirror and are pushed to
+    # a bare repository standing in for the real remote
+    remote = os.path.join(temp_dir, 'remote.git')
+    if sync_backend == 'git':
+        subprocess.run(['git', 'init', '--quiet', '--bare', remote], check=True)
+    # The server reads its configuration from the environment; the previous
+    # values are put back once the run is over
+    settings = {
+        'GITHUB_API_URL': fake_github.url,
+        'GITHUB_TOKEN': 'benchmark-token',
+        'GITHUB_USERNAME': 'benchmark',
+        'REPOSITORY_NAME': 'bench',
+        'REPOSITORIES': '',
+        'SYNC_BACKEND': sync_backend,
+        'GIT_MIRROR_DIR': os.path.join(temp_dir, 'mirrors'),
+        'GIT_REMOTES': 'file://' + remote,
+        'GIT_PUSH_INTERVAL': str(git_push_interval)
+    }
+    previous_environ = {name: os.environ.get(name) for name in settings}
+    os.environ.update(settings)
+    database = chat_server.Database(os.path.join(temp_dir, 'benchmark.db'))
+    stop_services = chat_server.start_services(database, workers)
+    sync_worker = chat_server.MessageHandler.sync_worker
+    httpd = chat_server.create_server(0, mode, workers)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    if mode == 'asyncio':
+        httpd.ready.wait(5)
+
+    git_stats = None
+    try:
+        deadline = time.monotonic() + duration
+        clients = [
+            ClientWorker(httpd.server_address[1], mix, deadline, seed + i)
+            for i in range(concurrency)
+        ]
+        started = time.monotonic()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.monotonic() - started
+        sync_status = sync_worker.status()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        stop_services()
+        # Let an in-flight push finish before its fake API goes away
+        sync_worker.executor.shutdown(wait=True)
+        database.close()
+        # Stopping pushed the mirror one last time; count before cleaning up
+        if sync_backend == 'git':
+            git_stats = _remote_stats(remote)
+        _cleanup(fake_github, previous_environ, temp_dir)
+
+    endpoints = {}
+    for name in mix:
+        latencies = sorted(value for client in clients for value in client.latencies[name])
+        endpoints[name] = {
+            'requests': len(latencies),
+            'errors': sum(client.errors[name] for client in clients),
+            'throughput_rps': round(len(latencies) / elapsed, 2),
+            'p50_ms': _ms(percentile(latencies, 0.50)),
+            'p95_ms': _ms(percentile(latencies, 0.95)),
+            'p99_ms': _ms(percentile(latencies, 0.99))
+        }
+    return {
+        'config': {
+            'duration': duration,
+            'concurrency': concurrency,
+            'mix': mix,
+            'mode': mode,
+            'workers': workers,
+            'github_latency': github_latency,
+            'github_rate_limit': github_rate_limit,
+            'sync_backend': sync_backend
+        },
+        'elapsed': round(elapsed, 3),
+        'endpoints': endpoints,
+        'github': {
+            'requests': fake_github.requests,
+            'rate_limited': fake_github.rate_limited,
+            'bytes_received': fake_github.bytes_received
+        },
+        'sync': {'pending': sync_status['pending']},
+        'git': git_stats
+    }
+
+def _cleanup(fake_github, previous_environ, temp_dir):
+    fake_github.shutdown()
+    fake_github.server_close()
+    for name, value in previous_environ.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+def _remote_stats(remote):
+    # Commits that reached the stand-in remote, i.e. how many commits the
+    # run's messages were batched into
+    result = subprocess.run(['git', '--git-dir', remote, 'rev-list', '--count', 'master'],
+                            capture_output=True, text=True)
+    return {'remote_commits': int(result.stdout.strip() or 0)}
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def find_regressions(result, baseline, tolerance):
+    # Endpoints whose p95 grew by more than tolerance (a fraction) over baseline
+    regressions = []
+    for name, stats in result['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous or not previous.get('p95_ms') or stats['p95_ms'] is None:
+            continue
+        if stats['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {stats['p95_ms']}ms vs baseline {previous['p95_ms']}ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test chat_server against a local fake GitHub API')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run the workload')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('--mix', type=parse_mix, default='post=1,get=2,poll=7',
+                        help='weighted operations, e.g. post=1,get=2,poll=7')
+    parser.add_argument('--mode', choices=chat_server.SERVER_MODES, default='threaded')
+    parser.add_argument('--workers', type=int, default=16, help='server worker threads')
+    parser.add_argument('--github-latency-ms', type=float, default=50.0)
+    parser.add_argument('--github-rate-limit', type=int, default=None,
+                        help='requests allowed per minute by the fake GitHub API')
+    parser.add_argument('--sync-backend', choices=('github', 'git'), default='github',
+                        help='sync through the fake GitHub API or a local git mirror with a file:// remote')
+    parser.add_argument('--git-push-interval', type=float, default=1.0,
+                        help='seconds between pushes from the git mirror to its remote')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON report to compare p95 latencies against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 growth over the baseline, as a fraction')
+    args = parser.parse_args()
+
+    result = run_benchmark(
+        duration=args.duration,
+        concurrency=args.concurrency,
+        mix=args.mix,
+        mode=args.mode,
+        workers=args.workers,
+        github_latency=args.github_latency_ms / 1000,
+        github_rate_limit=args.github_rate_limit,
+        sync_backend=args.sync_backend,
+        git_push_interval=args.git_push_interval
+    )
+    report = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"❌ Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,165 +1,2695 @@
 import os
 import json
+import argparse
 import http.server
 import socketserver
 from urllib.parse import parse_qs, urlparse
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 from dotenv import load_dotenv
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import hashlib
+import gzip
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
+import random
 import socket
+import re
+import threading
+import time
+import asyncio
+import io
+import collections
+from abc import ABC, abstractmethod
+import bisect
+import functools
+import logging
+import queue
+import signal
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Brotli is optional; without it static assets are offered gzip-compressed only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# fcntl is POSIX only; without it the server runs as a single process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger('chat_server')
+
+# SQL is kept in constants so sqlite3's per-connection statement cache
+# reuses the prepared statements instead of recompiling them on every call
+INSERT_MESSAGE_SQL = 'INSERT INTO messages (content, repository) VALUES (?, ?) RETURNING id, timestamp'
+INSERT_OUTBOX_SQL = 'INSERT INTO sync_outbox (message_id) VALUES (?)'
+# Keyset pagination walks the INTEGER PRIMARY KEY, so every page is a range
+# scan on the rowid b-tree regardless of how long the history is
+SELECT_MESSAGES_SQL = 'SELECT * FROM messages ORDER BY id'
+SELECT_MESSAGES_AFTER_SQL = 'SELECT * FROM messages WHERE id > ? AND id < ? ORDER BY id LIMIT ?'
+SELECT_MESSAGES_BEFORE_SQL = 'SELECT * FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?'
+# A repository's pages walk the (repository, id) index the same way
+SELECT_REPOSITORY_MESSAGES_AFTER_SQL = (
+    'SELECT * FROM messages WHERE repository = ? AND id > ? AND id < ? ORDER BY id LIMIT ?'
+)
+SELECT_REPOSITORY_MESSAGES_BEFORE_SQL = (
+    'SELECT * FROM messages WHERE repository = ? AND id < ? ORDER BY id DESC LIMIT ?'
+)
+SELECT_HAS_REPOSITORY_MESSAGES_BEFORE_SQL = (
+    'SELECT EXISTS (SELECT 1 FROM messages WHERE repository = ? AND id < ?)'
+)
+# Time-range pages are ordered by (timestamp, id), which is the order of the
+# timestamp index since SQLite appends the rowid to every index entry, so
+# rows sharing a one-second timestamp still come back in a stable order. The
+# cursor is still a message id; its timestamp is looked up by primary key,
+# and a cursor that is not a message continues from the edge of the range.
+SELECT_MESSAGES_BY_TIME_AFTER_SQL = (
+    'SELECT * FROM messages WHERE timestamp >= :start AND timestamp < :end '
+    'AND (timestamp, id) > (COALESCE((SELECT timestamp FROM messages WHERE id = :id), :start), :id) '
+    'AND (:repository IS NULL OR repository = :repository) ORDER BY timestamp, id LIMIT :limit'
+)
+SELECT_MESSAGES_BY_TIME_BEFORE_SQL = (
+    'SELECT * FROM messages WHERE timestamp >= :start AND timestamp < :end '
+    'AND (timestamp, id) < (COALESCE((SELECT timestamp FROM messages WHERE id = :id), :end), :id) '
+    'AND (:repository IS NULL OR repository = :repository) ORDER BY timestamp DESC, id DESC LIMIT :limit'
+)
+SELECT_HAS_MESSAGES_BEFORE_TIME_SQL = (
+    'SELECT EXISTS (SELECT 1 FROM messages WHERE timestamp >= :start '
+    'AND (timestamp, id) < (COALESCE((SELECT timestamp FROM messages WHERE id = :id), :end), :id) '
+    'AND (:repository IS NULL OR repository = :repository))'
+)
+SELECT_PENDING_MESSAGES_SQL = (
+    "SELECT m.* FROM sync_outbox o JOIN messages m ON m.id = o.message_id "
+    "WHERE o.status = 'pending' ORDER BY o.message_id"
+)
+SELECT_MESSAGES_IN_RANGE_SQL = {
+    'id': 'SELECT * FROM messages WHERE id >= ? AND id < ? ORDER BY id',
+    'timestamp': 'SELECT * FROM messages WHERE timestamp >= ? AND timestamp < ? ORDER BY id'
+}
+INSERT_MESSAGES_SQL = 'INSERT INTO messages (content, repository) VALUES (?, ?)'
+INSERT_OUTBOX_AFTER_SQL = 'INSERT INTO sync_outbox (message_id) SELECT id FROM messages WHERE id > ?'
+SELECT_LATEST_ID_SQL = 'SELECT COALESCE(MAX(id), 0) FROM messages'
+SELECT_IS_EMPTY_SQL = (
+    'SELECT NOT EXISTS (SELECT 1 FROM messages) AND NOT EXISTS (SELECT 1 FROM messages_archive)'
+)
+SELECT_HAS_MESSAGES_BEFORE_SQL = 'SELECT EXISTS (SELECT 1 FROM messages WHERE id < ?)'
+SELECT_IDEMPOTENCY_KEY_SQL = 'SELECT message_id FROM message_idempotency_keys WHERE key = ?'
+INSERT_IDEMPOTENCY_KEY_SQL = 'INSERT INTO message_idempotency_keys (key, message_id) VALUES (?, ?)'
+DELETE_IDEMPOTENCY_KEYS_SQL = 'DELETE FROM message_idempotency_keys WHERE message_id = ?'
+SELECT_MESSAGE_SQL = 'SELECT * FROM messages WHERE id = ?'
+SELECT_PENDING_SQL = "SELECT message_id FROM sync_outbox WHERE status = 'pending' ORDER BY message_id"
+COUNT_PENDING_SQL = "SELECT COUNT(*) FROM sync_outbox WHERE status = 'pending'"
+MARK_SYNCED_SQL = (
+    "UPDATE sync_outbox SET status = 'synced', last_error = NULL, "
+    "synced_at = CURRENT_TIMESTAMP WHERE message_id = ?"
+)
+MARK_COMMITTED_SQL = (
+    "UPDATE sync_outbox SET status = 'committed', commit_sha = ?, last_error = NULL WHERE message_id = ?"
+)
+SELECT_COMMITTED_SQL = "SELECT DISTINCT commit_sha FROM sync_outbox WHERE status = 'committed'"
+COUNT_COMMITTED_SQL = "SELECT COUNT(*) FROM sync_outbox WHERE status = 'committed'"
+MARK_COMMIT_SYNCED_SQL = (
+    "UPDATE sync_outbox SET status = 'synced', commit_sha = NULL, "
+    "synced_at = CURRENT_TIMESTAMP WHERE status = 'committed' AND commit_sha = ?"
+)
+INSERT_SYNC_REQUEST_SQL = 'INSERT INTO sync_requests DEFAULT VALUES'
+SELECT_OPEN_SYNC_REQUESTS_SQL = 'SELECT id FROM sync_requests WHERE completed_at IS NULL ORDER BY id'
+COMPLETE_SYNC_REQUEST_SQL = 'UPDATE sync_requests SET completed_at = CURRENT_TIMESTAMP, success = ? WHERE id = ?'
+SELECT_SYNC_REQUEST_SQL = 'SELECT completed_at IS NOT NULL, success FROM sync_requests WHERE id = ?'
+DELETE_OLD_SYNC_REQUESTS_SQL = "DELETE FROM sync_requests WHERE completed_at < datetime('now', '-1 hour')"
+MARK_SYNC_FAILED_SQL = 'UPDATE sync_outbox SET attempts = attempts + 1, last_error = ? WHERE message_id = ?'
+SELECT_SYNC_STATUS_SQL = (
+    'SELECT m.id, o.status, o.attempts, o.last_error, o.synced_at '
+    'FROM messages m LEFT JOIN sync_outbox o ON o.message_id = m.id WHERE m.id = ?'
+)
+
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+# Schema changes applied on top of the tables _create_table makes. Entry N
+# holds the statements that take PRAGMA user_version from N to N + 1; each
+# migration runs in its own transaction.
+MIGRATIONS = [
+    # 1: Full-text index over message content, kept in sync by triggers and
+    # backfilled from the rows that already exist
+    [
+        """CREATE VIRTUAL TABLE messages_fts USING fts5(
+            content, content='messages', content_rowid='id', tokenize='unicode61'
+        )""",
+        """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END""",
+        """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+        """CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END""",
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"
+    ],
+    # 2: Cold storage for messages past the retention age. Each row is one
+    # archiving batch, stored as zlib-compressed JSON.
+    [
+        """CREATE TABLE messages_archive (
+            id INTEGER PRIMARY KEY,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            first_timestamp DATETIME,
+            last_timestamp DATETIME,
+            message_count INTEGER NOT NULL,
+            body BLOB NOT NULL
+        )""",
+        'CREATE INDEX idx_messages_archive_first_id ON messages_archive (first_id)',
+        'CREATE INDEX idx_messages_archive_last_id ON messages_archive (last_id)'
+    ],
+    # 3: Per-repository and time-range queries
+    [
+        'CREATE INDEX idx_messages_repository_id ON messages (repository, id)',
+        'CREATE INDEX idx_messages_timestamp ON messages (timestamp)'
+    ],
+    # 4: Idempotency keys of the requests that created messages, so a
+    # retried POST maps back to its original message
+    [
+        '''CREATE TABLE message_idempotency_keys (
+            key TEXT PRIMARY KEY,
+            message_id INTEGER NOT NULL
+        ) WITHOUT ROWID''',
+        'CREATE INDEX idx_message_idempotency_keys_message_id ON message_idempotency_keys (message_id)'
+    ],
+    # 5: Mirror commit holding each message that is committed locally but
+    # has yet to reach the remotes
+    [
+        'ALTER TABLE sync_outbox ADD COLUMN commit_sha TEXT'
+    ],
+    # 6: Forced pushes that worker processes ask of the sync leader
+    [
+        """CREATE TABLE sync_requests (
+            id INTEGER PRIMARY KEY,
+            requested_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            completed_at DATETIME,
+            success INTEGER
+        )"""
+    ],
+]
+
+# Open ends of a time range; timestamps are stored as 'YYYY-MM-DD HH:MM:SS' text
+MIN_TIMESTAMP = ''
+MAX_TIMESTAMP = '9999-12-31 23:59:59'
+
+SEARCH_MESSAGES_SQL = (
+    "SELECT m.*, bm25(messages_fts) AS rank, "
+    "snippet(messages_fts, 0, '[', ']', '…', 12) AS snippet "
+    "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+    "WHERE messages_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?"
+)
+SEARCH_REPOSITORY_MESSAGES_SQL = (
+    "SELECT m.*, bm25(messages_fts) AS rank, "
+    "snippet(messages_fts, 0, '[', ']', '…', 12) AS snippet "
+    "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+    "WHERE messages_fts MATCH ? AND m.repository = ? ORDER BY rank LIMIT ? OFFSET ?"
+)
+
+# Retention moves the oldest rows out of messages in batches. Candidates are
+# bounded by id as well as age so that nothing still waiting for sync, or
+# sharing a repository shard with such a message, leaves the hot table.
+SELECT_ARCHIVE_CANDIDATES_SQL = 'SELECT * FROM messages WHERE id < ? AND timestamp < ? ORDER BY id LIMIT ?'
+INSERT_ARCHIVE_SQL = (
+    'INSERT INTO messages_archive '
+    '(first_id, last_id, first_timestamp, last_timestamp, message_count, body) VALUES (?, ?, ?, ?, ?, ?)'
+)
+DELETE_MESSAGE_SQL = 'DELETE FROM messages WHERE id = ?'
+DELETE_OUTBOX_SQL = 'DELETE FROM sync_outbox WHERE message_id = ?'
+SELECT_OLDEST_PENDING_TIMESTAMP_SQL = (
+    "SELECT MIN(m.timestamp) FROM sync_outbox o JOIN messages m ON m.id = o.message_id "
+    "WHERE o.status = 'pending'"
+)
+SELECT_FIRST_ID_SINCE_SQL = 'SELECT MIN(id) FROM messages WHERE timestamp >= ?'
+SELECT_ARCHIVE_AFTER_SQL = (
+    'SELECT first_id, last_id, body FROM messages_archive WHERE last_id > ? AND first_id < ? ORDER BY first_id'
+)
+SELECT_ARCHIVE_BEFORE_SQL = (
+    'SELECT first_id, last_id, body FROM messages_archive WHERE first_id < ? ORDER BY last_id DESC'
+)
+SELECT_HAS_ARCHIVE_BEFORE_SQL = 'SELECT EXISTS (SELECT 1 FROM messages_archive WHERE first_id < ?)'
+
+# Restores stage parsed sections in a temp table, then add the ones missing
+# from messages and the archive in a single statement. Duplicates are counted
+# rather than collapsed: a (timestamp, content) pair seen n times in one
+# source file needs n rows, and overlapping sources contribute their largest
+# count. Archived rows in the staged time range are unpacked into a second
+# temp table so that they count as present too.
+CREATE_RESTORE_STAGING_SQL = (
+    'CREATE TEMP TABLE IF NOT EXISTS restore_staging ('
+    'seq INTEGER PRIMARY KEY, source INTEGER, timestamp TEXT, content TEXT, repository TEXT)'
+)
+INSERT_RESTORE_STAGING_SQL = (
+    'INSERT INTO temp.restore_staging (source, timestamp, content, repository) VALUES (?, ?, ?, ?)'
+)
+CREATE_RESTORE_ARCHIVED_SQL = 'CREATE TEMP TABLE IF NOT EXISTS restore_archived (timestamp TEXT, content TEXT)'
+INSERT_RESTORE_ARCHIVED_SQL = 'INSERT INTO temp.restore_archived (timestamp, content) VALUES (?, ?)'
+SELECT_RESTORE_RANGE_SQL = 'SELECT MIN(timestamp), MAX(timestamp) FROM temp.restore_staging'
+SELECT_ARCHIVE_BETWEEN_SQL = (
+    'SELECT body FROM messages_archive WHERE last_timestamp >= ? AND first_timestamp <= ?'
+)
+RESTORE_MESSAGES_SQL = """
+    WITH numbered AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY source, timestamp, content ORDER BY seq) AS occurrence
+        FROM temp.restore_staging
+    ), incoming AS (
+        SELECT timestamp, content, MIN(repository) AS repository, occurrence, MIN(seq) AS seq
+        FROM numbered GROUP BY timestamp, content, occurrence
+    ), existing AS (
+        SELECT timestamp, content, COUNT(*) AS copies FROM (
+            SELECT timestamp, content FROM messages
+            WHERE timestamp BETWEEN (SELECT MIN(timestamp) FROM temp.restore_staging)
+                                AND (SELECT MAX(timestamp) FROM temp.restore_staging)
+            UNION ALL
+            SELECT timestamp, content FROM temp.restore_archived
+        )
+        GROUP BY timestamp, content
+    )
+    INSERT INTO messages (content, timestamp, repository)
+    SELECT i.content, i.timestamp, i.repository FROM incoming i
+    LEFT JOIN existing e ON e.timestamp = i.timestamp AND e.content = i.content
+    WHERE i.occurrence > COALESCE(e.copies, 0)
+    ORDER BY i.timestamp, i.seq
+"""
+
+# Prometheus-style metrics kept in process memory and rendered in the text
+# exposition format by GET /metrics. Each update is a dict lookup and an add
+# under a lock, cheap enough for every request and query.
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}')
+        return lines
+
+class Gauge:
+    # Read from a callback at scrape time, so nothing is tracked in between
+    def __init__(self, name, help_text, callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        if self.callback is not None:
+            lines.append(f'{self.name} {_format_value(self.callback())}')
+        return lines
+
+# Upper bounds in seconds, from sub-millisecond queries to slow GitHub calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return sum(series[0]) if series else 0
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((label_values, list(counts), total) for label_values, (counts, total) in self._series.items())
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels + ('le',), label_values + (str(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics.register(Histogram(
+    'chat_http_request_duration_seconds', 'Time spent handling HTTP requests.', ('method', 'route')
+))
+HTTP_RESPONSES = metrics.register(Counter(
+    'chat_http_responses_total', 'HTTP responses sent.', ('method', 'route', 'status')
+))
+SQLITE_QUERY_SECONDS = metrics.register(Histogram(
+    'chat_sqlite_query_duration_seconds', 'Time spent in SQLite calls.', ('operation',)
+))
+GITHUB_REQUEST_SECONDS = metrics.register(Histogram(
+    'chat_github_request_duration_seconds', 'GitHub API request latency.', ('method',)
+))
+GITHUB_RESPONSES = metrics.register(Counter(
+    'chat_github_responses_total', 'GitHub API responses by status; network failures count as "error".',
+    ('method', 'status')
+))
+GITHUB_BYTES_PUSHED = metrics.register(Counter(
+    'chat_github_pushed_bytes_total', 'Request body bytes sent to GitHub by file updates.'
+))
+SYNC_QUEUE_DEPTH = metrics.register(Gauge(
+    'chat_sync_queue_depth', 'Messages waiting in the sync outbox.'
+))
+
+def _timed_query(method):
+    # Records the wrapped Database call under its own name
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with SQLITE_QUERY_SECONDS.time(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class Database:
-    def __init__(self, db_path='messages.db'):
-        self.conn = sqlite3.connect(db_path)
-        self.cursor = self.conn.cursor()
+    # Each thread keeps one long-lived connection; the schema is checked once
+    # per process rather than once per request
+    def __init__(self, db_path='messages.db', cached_statements=128):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # Writes are serialised so listeners see new messages in id order
+        self._write_lock = threading.Lock()
+        self._listeners = []
+        # Bumped on every committed write; response caches key on it
+        self.version = 0
         self._create_table()
 
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        # WAL lets readers proceed while a writer commits; NORMAL is durable
+        # across application crashes and only risks the last commit on power loss
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-8000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
     def _create_table(self):
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                content TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                repository TEXT
+        with self.conn as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    content TEXT NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    repository TEXT
+                )
+            ''')
+            # Durable outbox of messages still waiting to reach the repository
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_outbox (
+                    message_id INTEGER PRIMARY KEY REFERENCES messages(id),
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    enqueued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    synced_at DATETIME
+                )
+            ''')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_sync_outbox_status ON sync_outbox (status, message_id)'
             )
-        ''')
-        self.conn.commit()
+        self._migrate()
+
+    def _migrate(self):
+        conn = self.conn
+        while True:
+            with conn:
+                # Re-read under the write lock in case another process migrated first
+                conn.execute('BEGIN IMMEDIATE')
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    return
+                for statement in MIGRATIONS[version]:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+
+    def add_listener(self, listener):
+        # listener(messages) is called after each commit with the new rows
+        self._listeners.append(listener)
+
+    def _notify(self, messages):
+        self.version += 1
+        for listener in self._listeners:
+            listener(messages)
+
+    @_timed_query
+    def add_message(self, content, repository, idempotency_key=None):
+        # The message and its outbox entry are committed together. A key
+        # that was seen before returns the id of the message it created.
+        if idempotency_key is not None:
+            return self.add_messages([(content, repository, idempotency_key)])[0]['id']
+        with self._write_lock:
+            with self.conn as conn:
+                message_id, timestamp = conn.execute(INSERT_MESSAGE_SQL, (content, repository)).fetchone()
+                conn.execute(INSERT_OUTBOX_SQL, (message_id,))
+            self._notify([{
+                'id': message_id,
+                'content': content,
+                'timestamp': timestamp,
+                'repository': repository
+            }])
+        return message_id
+
+    @_timed_query
+    def add_messages(self, messages):
+        # Inserts (content, repository) pairs in one transaction, so a whole
+        # batch costs a single commit. Returns one row per message, in order.
+        # A message may carry an idempotency key as a third item; if the key
+        # was seen before, nothing is written and the row of the message it
+        # created is returned instead.
+        if not messages:
+            return []
+        with self._write_lock:
+            with self.conn as conn:
+                # BEGIN IMMEDIATE takes the write lock before reading the
+                # high-water mark, so every id above it belongs to this batch
+                conn.execute('BEGIN IMMEDIATE')
+                latest_id = conn.execute(SELECT_LATEST_ID_SQL).fetchone()[0]
+                # Positions in messages whose key belongs to an earlier
+                # request (-> its message id) or to a message inserted
+                # earlier in this batch (-> that message's position)
+                existing, repeated, first_with_key = {}, {}, {}
+                for position, message in enumerate(messages):
+                    key = message[2] if len(message) > 2 else None
+                    if key is None:
+                        continue
+                    if key in first_with_key:
+                        repeated[position] = first_with_key[key]
+                        continue
+                    row = conn.execute(SELECT_IDEMPOTENCY_KEY_SQL, (key,)).fetchone()
+                    if row is None:
+                        first_with_key[key] = position
+                    else:
+                        existing[position] = row[0]
+                inserted = [
+                    position for position in range(len(messages))
+                    if position not in existing and position not in repeated
+                ]
+                conn.executemany(INSERT_MESSAGES_SQL, (messages[position][:2] for position in inserted))
+                conn.execute(INSERT_OUTBOX_AFTER_SQL, (latest_id,))
+                cursor = conn.execute(SELECT_MESSAGES_AFTER_SQL, (latest_id, SQLITE_MAX_INT, -1))
+                rows = self._rows_to_dicts(cursor, cursor.fetchall())
+                if first_with_key:
+                    row_at = dict(zip(inserted, rows))
+                    conn.executemany(INSERT_IDEMPOTENCY_KEY_SQL, (
+                        (key, row_at[position]['id']) for key, position in first_with_key.items()
+                    ))
+            if rows:
+                self._notify(rows)
+        if not existing and not repeated:
+            return rows
+        results = dict(zip(inserted, rows))
+        for position, message_id in existing.items():
+            results[position] = self._get_message(message_id)
+        for position, first in repeated.items():
+            results[position] = results[first]
+        return [results[position] for position in range(len(messages))]
+
+    def _get_message(self, message_id):
+        # The message may since have moved to the archive; its id still stands
+        cursor = self.conn.execute(SELECT_MESSAGE_SQL, (message_id,))
+        rows = self._rows_to_dicts(cursor, cursor.fetchall())
+        return rows[0] if rows else {'id': message_id}
+
+    @_timed_query
+    def archive_messages(self, before_id, before_timestamp, batch_size=1000):
+        # Moves up to batch_size of the oldest messages with an id below
+        # before_id and a timestamp below before_timestamp into one
+        # compressed archive row, in a single transaction. Returns the count.
+        with self._write_lock:
+            with self.conn as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                cursor = conn.execute(SELECT_ARCHIVE_CANDIDATES_SQL, (before_id, before_timestamp, batch_size))
+                rows = self._rows_to_dicts(cursor, cursor.fetchall())
+                if not rows:
+                    return 0
+                body = zlib.compress(json.dumps(rows, separators=(',', ':')).encode())
+                conn.execute(INSERT_ARCHIVE_SQL, (
+                    rows[0]['id'], rows[-1]['id'],
+                    min(row['timestamp'] for row in rows), max(row['timestamp'] for row in rows),
+                    len(rows), body
+                ))
+                ids = [(row['id'],) for row in rows]
+                conn.executemany(DELETE_MESSAGE_SQL, ids)
+                conn.executemany(DELETE_OUTBOX_SQL, ids)
+                # Retries arrive within minutes, not after the retention age
+                conn.executemany(DELETE_IDEMPOTENCY_KEYS_SQL, ids)
+            # Cached pages may still list the archived rows
+            self.version += 1
+        return len(rows)
+
+    @_timed_query
+    def get_archived_messages(self, since_id=None, before_id=None, limit=100):
+        # Same paging as get_messages over the archive: since_id pages
+        # forward, otherwise the newest rows below before_id. Only the
+        # archive rows overlapping the page are decompressed.
+        upper = before_id if before_id is not None else SQLITE_MAX_INT
+        if since_id is not None:
+            cursor = self.conn.execute(SELECT_ARCHIVE_AFTER_SQL, (since_id, upper))
+            keep = lambda row: since_id < row['id'] < upper
+        else:
+            cursor = self.conn.execute(SELECT_ARCHIVE_BEFORE_SQL, (upper,))
+            keep = lambda row: row['id'] < upper
+        messages = []
+        for first_id, last_id, body in cursor:
+            # Archive rows are ordered so that, once the page is full, the
+            # first one lying wholly beyond it ends the scan
+            if len(messages) >= limit:
+                if since_id is not None and first_id > messages[-1]['id']:
+                    break
+                if since_id is None and last_id < messages[0]['id']:
+                    break
+            rows = [row for row in json.loads(zlib.decompress(body)) if keep(row)]
+            messages = sorted(messages + rows, key=lambda row: row['id'])
+            messages = messages[:limit] if since_id is not None else messages[-limit:]
+        cursor.close()
+        return messages
+
+    def has_archived_messages_before(self, message_id):
+        return bool(self.conn.execute(SELECT_HAS_ARCHIVE_BEFORE_SQL, (message_id,)).fetchone()[0])
+
+    def get_oldest_pending_timestamp(self):
+        return self.conn.execute(SELECT_OLDEST_PENDING_TIMESTAMP_SQL).fetchone()[0]
+
+    def get_first_id_since(self, timestamp):
+        return self.conn.execute(SELECT_FIRST_ID_SINCE_SQL, (timestamp,)).fetchone()[0]
+
+    @_timed_query
+    def restore_messages(self, sources):
+        # sources yields (repository, [(timestamp, content), ...]) per file.
+        # Sections are staged as they stream in, then the missing ones are
+        # inserted in one write transaction. Restored messages are already in
+        # the repository, so none is queued for sync. Returns the count added.
+        conn = self.conn
+        conn.execute(CREATE_RESTORE_STAGING_SQL)
+        conn.execute(CREATE_RESTORE_ARCHIVED_SQL)
+        try:
+            # The temp table is private to this connection; staging takes no
+            # write lock on the database while a download is in progress
+            with conn:
+                for source, (repository, sections) in enumerate(sources):
+                    conn.executemany(INSERT_RESTORE_STAGING_SQL, (
+                        (source, timestamp, content, repository) for timestamp, content in sections
+                    ))
+            with self._write_lock:
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    self._stage_archived_messages()
+                    conn.execute(RESTORE_MESSAGES_SQL)
+                    # rowcount is only kept for statements that begin with INSERT
+                    restored = conn.execute('SELECT changes()').fetchone()[0]
+                if restored:
+                    self.version += 1
+        finally:
+            conn.execute('DROP TABLE IF EXISTS temp.restore_staging')
+            conn.execute('DROP TABLE IF EXISTS temp.restore_archived')
+        return restored
 
-    def add_message(self, content, repository):
-        self.cursor.execute(
-            'INSERT INTO messages (content, repository) VALUES (?, ?)', 
-            (content, repository)
+    def _stage_archived_messages(self):
+        # Unpacks the archive rows overlapping the staged time range, inside
+        # the restore transaction so that retention cannot move rows between
+        # the archive check and the insert
+        first, last = self.conn.execute(SELECT_RESTORE_RANGE_SQL).fetchone()
+        if first is None:
+            return
+        for (body,) in self.conn.execute(SELECT_ARCHIVE_BETWEEN_SQL, (first, last)).fetchall():
+            self.conn.executemany(INSERT_RESTORE_ARCHIVED_SQL, (
+                (row['timestamp'], row['content']) for row in json.loads(zlib.decompress(body))
+                if first <= row['timestamp'] <= last
+            ))
+
+    def is_empty(self):
+        # No messages, hot or archived
+        return bool(self.conn.execute(SELECT_IS_EMPTY_SQL).fetchone()[0])
+
+    @_timed_query
+    def get_latest_id(self):
+        return self.conn.execute(SELECT_LATEST_ID_SQL).fetchone()[0]
+
+    @_timed_query
+    def get_messages(self, since_id=None, before_id=None, limit=None, repository=None, start=None, end=None):
+        # since_id pages forward from a cursor; before_id or a bare limit
+        # returns the newest rows below the cursor. Rows are always ascending:
+        # by id, or by (timestamp, id) when a time range [start, end) is given.
+        if start is not None or end is not None:
+            return self._get_messages_by_time(since_id, before_id, limit, repository, start, end)
+        if repository is not None:
+            return self._get_repository_messages(repository, since_id, before_id, limit)
+        if since_id is not None:
+            cursor = self.conn.execute(SELECT_MESSAGES_AFTER_SQL, (
+                since_id,
+                before_id if before_id is not None else SQLITE_MAX_INT,
+                limit if limit is not None else -1
+            ))
+            return self._rows_to_dicts(cursor, cursor.fetchall())
+        if before_id is not None or limit is not None:
+            cursor = self.conn.execute(SELECT_MESSAGES_BEFORE_SQL, (
+                before_id if before_id is not None else SQLITE_MAX_INT,
+                limit if limit is not None else -1
+            ))
+            return self._rows_to_dicts(cursor, reversed(cursor.fetchall()))
+        cursor = self.conn.execute(SELECT_MESSAGES_SQL)
+        return self._rows_to_dicts(cursor, cursor.fetchall())
+
+    def _get_repository_messages(self, repository, since_id, before_id, limit):
+        upper = before_id if before_id is not None else SQLITE_MAX_INT
+        if since_id is None and (before_id is not None or limit is not None):
+            cursor = self.conn.execute(SELECT_REPOSITORY_MESSAGES_BEFORE_SQL, (
+                repository, upper, limit if limit is not None else -1
+            ))
+            return self._rows_to_dicts(cursor, reversed(cursor.fetchall()))
+        cursor = self.conn.execute(SELECT_REPOSITORY_MESSAGES_AFTER_SQL, (
+            repository, since_id or 0, upper, limit if limit is not None else -1
+        ))
+        return self._rows_to_dicts(cursor, cursor.fetchall())
+
+    def _get_messages_by_time(self, since_id, before_id, limit, repository, start, end):
+        params = {
+            'start': start if start is not None else MIN_TIMESTAMP,
+            'end': end if end is not None else MAX_TIMESTAMP,
+            'repository': repository,
+            'limit': limit if limit is not None else -1
+        }
+        if since_id is not None:
+            params['id'] = since_id
+            cursor = self.conn.execute(SELECT_MESSAGES_BY_TIME_AFTER_SQL, params)
+            return self._rows_to_dicts(cursor, cursor.fetchall())
+        params['id'] = before_id if before_id is not None else SQLITE_MAX_INT
+        cursor = self.conn.execute(SELECT_MESSAGES_BY_TIME_BEFORE_SQL, params)
+        return self._rows_to_dicts(cursor, reversed(cursor.fetchall()))
+
+    @_timed_query
+    def search_messages(self, query, repository=None, limit=50, offset=0):
+        # Best matches first; bm25 ranks lower (more negative) for better matches
+        if repository is None:
+            cursor = self.conn.execute(SEARCH_MESSAGES_SQL, (query, limit, offset))
+        else:
+            cursor = self.conn.execute(SEARCH_REPOSITORY_MESSAGES_SQL, (query, repository, limit, offset))
+        return self._rows_to_dicts(cursor, cursor.fetchall())
+
+    def iter_messages(self, since_id=0, before_id=None, limit=None, batch_size=500, repository=None):
+        # Walks forward from since_id holding at most batch_size rows in
+        # memory, for responses that stream the whole history
+        params = (
+            since_id,
+            before_id if before_id is not None else SQLITE_MAX_INT,
+            limit if limit is not None else -1
         )
-        self.conn.commit()
-        return self.cursor.lastrowid
+        if repository is None:
+            cursor = self.conn.execute(SELECT_MESSAGES_AFTER_SQL, params)
+        else:
+            cursor = self.conn.execute(SELECT_REPOSITORY_MESSAGES_AFTER_SQL, (repository,) + params)
+        columns = [col[0] for col in cursor.description]
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(zip(columns, row))
+        finally:
+            cursor.close()
+
+    def _rows_to_dicts(self, cursor, rows):
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in rows]
+
+    @_timed_query
+    def get_pending_sync_messages(self):
+        cursor = self.conn.execute(SELECT_PENDING_MESSAGES_SQL)
+        return self._rows_to_dicts(cursor, cursor.fetchall())
+
+    @_timed_query
+    def get_messages_in_range(self, column, start, end):
+        cursor = self.conn.execute(SELECT_MESSAGES_IN_RANGE_SQL[column], (start, end))
+        return self._rows_to_dicts(cursor, cursor.fetchall())
+
+    @_timed_query
+    def has_messages_before(self, message_id, repository=None, start=None, end=None):
+        # Whether a page starting at message_id has an older page, under the
+        # same filters and ordering get_messages used for it
+        if start is not None or end is not None:
+            return bool(self.conn.execute(SELECT_HAS_MESSAGES_BEFORE_TIME_SQL, {
+                'start': start if start is not None else MIN_TIMESTAMP,
+                'end': end if end is not None else MAX_TIMESTAMP,
+                'repository': repository,
+                'id': message_id
+            }).fetchone()[0])
+        if repository is not None:
+            return bool(self.conn.execute(
+                SELECT_HAS_REPOSITORY_MESSAGES_BEFORE_SQL, (repository, message_id)
+            ).fetchone()[0])
+        return bool(self.conn.execute(SELECT_HAS_MESSAGES_BEFORE_SQL, (message_id,)).fetchone()[0])
+
+    @_timed_query
+    def get_pending_sync(self):
+        return [row[0] for row in self.conn.execute(SELECT_PENDING_SQL)]
+
+    @_timed_query
+    def count_pending_sync(self):
+        return self.conn.execute(COUNT_PENDING_SQL).fetchone()[0]
+
+    @_timed_query
+    def mark_synced(self, message_ids):
+        with self.conn as conn:
+            conn.executemany(MARK_SYNCED_SQL, [(message_id,) for message_id in message_ids])
+
+    @_timed_query
+    def mark_committed(self, message_ids, commit):
+        # Written to a local mirror; synced once commit reaches the remotes
+        with self.conn as conn:
+            conn.executemany(MARK_COMMITTED_SQL, [(commit, message_id) for message_id in message_ids])
+
+    @_timed_query
+    def get_committed_commits(self):
+        return [row[0] for row in self.conn.execute(SELECT_COMMITTED_SQL)]
+
+    @_timed_query
+    def count_committed_sync(self):
+        return self.conn.execute(COUNT_COMMITTED_SQL).fetchone()[0]
+
+    @_timed_query
+    def mark_commits_synced(self, commits):
+        with self.conn as conn:
+            conn.executemany(MARK_COMMIT_SYNCED_SQL, [(commit,) for commit in commits])
+
+    @_timed_query
+    def request_sync(self):
+        # Records a forced push for the sync leader; returns the request id
+        with self.conn as conn:
+            return conn.execute(INSERT_SYNC_REQUEST_SQL).lastrowid
+
+    @_timed_query
+    def get_open_sync_requests(self):
+        return [row[0] for row in self.conn.execute(SELECT_OPEN_SYNC_REQUESTS_SQL)]
+
+    @_timed_query
+    def complete_sync_requests(self, request_ids, success):
+        with self.conn as conn:
+            conn.executemany(COMPLETE_SYNC_REQUEST_SQL, [(int(success), request_id) for request_id in request_ids])
+            # Whoever asked has stopped waiting long since
+            conn.execute(DELETE_OLD_SYNC_REQUESTS_SQL)
+
+    @_timed_query
+    def get_sync_request(self, request_id):
+        # None while the request is open, then whether the push succeeded
+        row = self.conn.execute(SELECT_SYNC_REQUEST_SQL, (request_id,)).fetchone()
+        if row is None or not row[0]:
+            return None
+        return bool(row[1])
+
+    @_timed_query
+    def mark_sync_failed(self, message_ids, error):
+        # Failed entries stay pending so the next push retries them
+        with self.conn as conn:
+            conn.executemany(
+                MARK_SYNC_FAILED_SQL,
+                [(error, message_id) for message_id in message_ids]
+            )
+
+    @_timed_query
+    def get_sync_status(self, message_id):
+        row = self.conn.execute(SELECT_SYNC_STATUS_SQL, (message_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row[0],
+            # Messages written before the outbox existed were pushed inline
+            'status': row[1] or 'untracked',
+            'attempts': row[2] or 0,
+            'last_error': row[3],
+            'synced_at': row[4]
+        }
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(db_path='messages.db'):
+    # Process-wide Database service shared by every request handler
+    with _databases_lock:
+        database = _databases.get(db_path)
+        if database is None:
+            database = _databases[db_path] = Database(db_path)
+        return database
+
+# Gathers single-message inserts from concurrent requests that arrive within
+# a few milliseconds of each other and commits them in one transaction, so
+# under load many messages share one fsync.
+class GroupCommitWriter(threading.Thread):
+    def __init__(self, database, window=0.002, max_batch=500):
+        super().__init__(name='group-commit', daemon=True)
+        self.database = database
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+
+    def submit(self, content, repository, idempotency_key=None):
+        # Returns a Future resolving to the new message id, or to the id of
+        # the message an earlier request with the same key created
+        future = Future()
+        self._queue.put(((content, repository, idempotency_key), future))
+        return future
+
+    def stop(self, timeout=None):
+        self._queue.put(None)
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            stopping = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch):
+        try:
+            rows = self.database.add_messages([message for message, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # One bad message must not fail the others that shared its
+            # transaction; insert them one at a time so only it fails
+            for item in batch:
+                self._commit_one(item)
+            return
+        for row, (_, future) in zip(rows, batch):
+            future.set_result(row['id'])
+
+    def _commit_one(self, item):
+        message, future = item
+        try:
+            rows = self.database.add_messages([message])
+        except Exception as e:
+            future.set_exception(e)
+            return
+        future.set_result(rows[0]['id'])
+
+# Quota reported by the GitHub API on every response. Primary limits come from
+# X-RateLimit-Remaining/X-RateLimit-Reset; secondary limits from Retry-After.
+class RateLimitState:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, status_code, headers, now=None):
+        now = time.time() if now is None else now
+        try:
+            limit = headers.get('X-RateLimit-Limit')
+            remaining = headers.get('X-RateLimit-Remaining')
+            reset_at = headers.get('X-RateLimit-Reset')
+            retry_after = headers.get('Retry-After')
+            with self._lock:
+                if limit is not None:
+                    self.limit = int(limit)
+                if remaining is not None:
+                    self.remaining = int(remaining)
+                if reset_at is not None:
+                    self.reset_at = float(reset_at)
+                if status_code in (403, 429):
+                    if retry_after is not None:
+                        self.blocked_until = now + float(retry_after)
+                    elif self.remaining == 0 and self.reset_at:
+                        self.blocked_until = self.reset_at
+                    else:
+                        # Secondary limit without a hint: GitHub asks for at least a minute
+                        self.blocked_until = now + 60
+        except (AttributeError, TypeError, ValueError):
+            # Responses without usable rate limit headers leave the state alone
+            pass
+
+    def wait_time(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            wait = self.blocked_until - now
+            if self.remaining == 0 and self.reset_at:
+                wait = max(wait, self.reset_at - now)
+            return max(0.0, wait)
+
+    def pacing_interval(self, now=None):
+        # Spread the remaining quota evenly over the time left in the window
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self.remaining or not self.reset_at or self.reset_at <= now:
+                return 0.0
+            return (self.reset_at - now) / self.remaining
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'remaining': self.remaining,
+                'reset_at': self.reset_at,
+                'blocked_until': self.blocked_until or None
+            }
+
+# Decides when the sync worker may push next: a debounce window gathers a
+# burst of messages into one push, failures back off exponentially with
+# jitter, and the remaining quota paces pushes until the limit resets.
+class PushScheduler:
+    def __init__(self, debounce=2.0, backoff_base=1.0, backoff_max=300.0):
+        self.debounce = debounce
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failures = 0
+        self.backoff_until = 0.0
+        self.last_push_at = 0.0
+
+    def record_success(self, now=None):
+        self.failures = 0
+        self.backoff_until = 0.0
+        self.last_push_at = time.time() if now is None else now
+
+    def record_failure(self, now=None):
+        now = time.time() if now is None else now
+        self.failures += 1
+        self.last_push_at = now
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self.failures - 1))
+        # "Equal jitter" keeps at least half the delay while spreading retries
+        self.backoff_until = now + delay / 2 + random.uniform(0, delay / 2)
+
+    def next_delay(self, rate_limit, now=None):
+        now = time.time() if now is None else now
+        paced_at = self.last_push_at + rate_limit.pacing_interval(now)
+        return max(0.0, self.backoff_until - now, paced_at - now, rate_limit.wait_time(now))
 
-    def get_messages(self):
-        self.cursor.execute('SELECT * FROM messages ORDER BY timestamp')
-        columns = [col[0] for col in self.cursor.description]
-        return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+    def snapshot(self):
+        return {
+            'debounce': self.debounce,
+            'failures': self.failures,
+            'backoff_until': self.backoff_until or None
+        }
+
+# Where the sync worker stores messages. Messages are kept as one markdown
+# shard per day (or per shard_size messages) under shard_dir; push_messages
+# is given every message of each shard it should write, and restore reads
+# the shards back through history_files and iter_file_lines.
+class SyncBackend(ABC):
+    # History pushed before messages were sharded lives in this single file
+    legacy_file = 'chat_messages.md'
+
+    def __init__(self, repository_name, shard_by='day', shard_size=1000, shard_dir='chat_messages'):
+        if shard_by not in ('day', 'count'):
+            raise ValueError(f"shard_by must be 'day' or 'count', not {shard_by!r}")
+        self.repository_name = repository_name
+        self.shard_by = shard_by
+        self.shard_size = shard_size
+        self.shard_dir = shard_dir
+        # Backends without a quota leave it empty and never make pushes wait
+        self.rate_limit = RateLimitState()
+        # One backend is shared by all request threads and the sync worker;
+        # pushes to the same file must not interleave
+        self._lock = threading.Lock()
+        self._publish_listeners = []
+
+    @property
+    def location(self):
+        return self.repository_name
+
+    def add_publish_listener(self, listener):
+        # listener(backend, commit) is called once every remote has commit
+        self._publish_listeners.append(listener)
+
+    def unpublished_commit(self):
+        # The local commit holding the last pushed messages while it has yet
+        # to reach the remotes; backends that push straight to the remote
+        # have none
+        return None
+
+    def includes(self, head, commit):
+        # Whether commit is head or one of its ancestors
+        return commit == head
+
+    def start(self):
+        # Background work of the backend; runs alongside the sync worker
+        pass
+
+    def stop(self, timeout=None):
+        pass
+
+    def shard_key(self, message):
+        if self.shard_by == 'count':
+            start = message.get('id', 0) // self.shard_size * self.shard_size
+            return f'{start:08d}-{start + self.shard_size - 1:08d}'
+        timestamp = message.get('timestamp')
+        return timestamp[:10] if timestamp else 'undated'
+
+    def shard_path(self, message):
+        return f'{self.shard_dir}/{self.shard_key(message)}.md'
+
+    def shard_range(self, message):
+        # (column, start, end) bounds of the rows stored in message's shard,
+        # end exclusive, so the sync worker can load just the touched shards
+        if self.shard_by == 'count':
+            start = message['id'] // self.shard_size * self.shard_size
+            return ('id', start, start + self.shard_size)
+        day = datetime.strptime(message['timestamp'][:10], '%Y-%m-%d')
+        return ('timestamp', day.strftime('%Y-%m-%d'), (day + timedelta(days=1)).strftime('%Y-%m-%d'))
+
+    def render_shard(self, messages):
+        # Joined once at the end; repeated += would copy the document per message
+        parts = ["# Chat Messages\n\n"]
+        for msg in messages:
+            parts.append(f"## {msg.get('timestamp', 'No Timestamp')}\n{msg.get('content', 'No Content')}\n\n")
+        return ''.join(parts)
 
-class RepositoryManager:
-    def __init__(self, github_token, github_username, repository_name):
+    def _shards(self, messages):
+        shards = {}
+        for msg in messages:
+            shards.setdefault(self.shard_path(msg), []).append(msg)
+        return shards
+
+    def _is_history_file(self, path):
+        return path == self.legacy_file or (path.startswith(self.shard_dir + '/') and path.endswith('.md'))
+
+    def push_messages(self, messages):
+        with self._lock:
+            return self._push_messages(messages)
+
+    @abstractmethod
+    def _push_messages(self, messages):
+        # Writes the given shards; returns whether the push succeeded
+        pass
+
+    @abstractmethod
+    def history_files(self):
+        # Paths of the history files stored in the backend
+        pass
+
+    @abstractmethod
+    def iter_file_lines(self, file_path):
+        # Streams the lines of one history file
+        pass
+
+class RepositoryManager(SyncBackend):
+    # Pushes shards through the GitHub contents API, one PUT per changed
+    # shard, so a push only uploads the shards that changed
+    def __init__(self, github_token, github_username, repository_name,
+                 shard_by='day', shard_size=1000, shard_dir='chat_messages',
+                 timeout=(5, 30), pool_size=4, api_url='https://api.github.com'):
+        super().__init__(repository_name, shard_by, shard_size, shard_dir)
         self.github_token = github_token
         self.github_username = github_username
-        self.repository_name = repository_name
         self.headers = {
             'Authorization': f'token {self.github_token}',
             'Accept': 'application/vnd.github.v3+json'
         }
+        # Shard path -> digest of the content last pushed successfully
+        self.synced_shards = {}
+        # Shard path -> blob SHA returned by our last PUT, so updates skip the GET
+        self.file_shas = {}
+        # Shard path -> (ETag, SHA) of the last read, for conditional GETs
+        self._etags = {}
+        # Keep TLS connections to the API open between pushes
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.api_url = api_url.rstrip('/')
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
-    def push_messages(self, messages):
-        try:
-            # Extensive logging for debugging
-            print(f"🔍 Attempting to push {len(messages)} messages to repository")
-            print(f"Repository: {self.repository_name}")
-            print(f"GitHub Username: {self.github_username}")
-            print(f"GitHub Token: {'*' * 8 + self.github_token[-4:] if self.github_token else 'Not Set'}")
+    @property
+    def location(self):
+        return f'{self.github_username}/{self.repository_name}'
 
-            # Validate inputs
+    def _push_messages(self, messages):
+        try:
             if not messages:
-                print("❌ No messages to push")
+                logger.warning('push skipped repository=%s reason=no_messages', self.repository_name)
                 return False
+            logger.debug('push start repository=%s messages=%d', self.repository_name, len(messages))
 
-            # Create a markdown file with messages
-            content = "# Chat Messages\n\n"
-            for msg in messages:
-                timestamp = msg.get('timestamp', 'No Timestamp')
-                message_content = msg.get('content', 'No Content')
-                content += f"## {timestamp}\n{message_content}\n\n"
+            success = True
+            for file_path, shard_messages in self._shards(messages).items():
+                if self.rate_limit.wait_time() > 0:
+                    # Leave the remaining shards for after the limit resets
+                    logger.warning('push deferred repository=%s reason=rate_limited', self.repository_name)
+                    return False
+                content = self.render_shard(shard_messages)
+                digest = hashlib.sha256(content.encode()).hexdigest()
+                if self.synced_shards.get(file_path) == digest:
+                    continue
+                if self._push_file(file_path, content, len(shard_messages)):
+                    self.synced_shards[file_path] = digest
+                else:
+                    success = False
+            return success
+        
+        except Exception:
+            logger.exception('push failed repository=%s', self.repository_name)
+            return False
 
-            # Get the current SHA of the file (if it exists)
-            file_path = 'chat_messages.md'
-            try:
-                url = f'https://api.github.com/repos/{self.github_username}/{self.repository_name}/contents/{file_path}'
-                
-                # Log the exact API request details
-                print(f"🌐 GitHub API URL: {url}")
-                
-                # First, try to get the existing file
-                get_response = requests.get(url, headers=self.headers)
-                print(f"GET Response Status: {get_response.status_code}")
-                print(f"GET Response Content: {get_response.text}")
-                
-                # Prepare payload for creating/updating file
-                payload = {
-                    'message': f'Update chat messages ({len(messages)} total)',
-                    'content': base64.b64encode(content.encode()).decode(),
-                    'branch': 'master'  # Explicitly set to master
-                }
-                
-                # If file exists, include its SHA for update
-                if get_response.status_code == 200:
-                    existing_file = get_response.json()
-                    payload['sha'] = existing_file['sha']
-                
-                # Log the PUT payload
-                print(f"📤 Payload Message: {payload['message']}")
-                print(f"📤 Payload Content Length: {len(payload['content'])} bytes")
-                
-                # Perform the PUT request to create/update the file
-                put_response = requests.put(url, 
-                    headers=self.headers, 
-                    data=json.dumps(payload)
-                )
-                
-                # Log the PUT response details
-                print(f"PUT Response Status: {put_response.status_code}")
-                print(f"PUT Response Content: {put_response.text}")
-                
-                # Check for successful response
-                if put_response.status_code in [200, 201]:
-                    print("✅ Messages successfully pushed to GitHub!")
-                    return True
+    def _contents_url(self, file_path):
+        return f'{self.api_url}/repos/{self.github_username}/{self.repository_name}/contents/{file_path}'
+
+    def _push_file(self, file_path, content, message_count):
+        try:
+            url = self._contents_url(file_path)
+            
+            # Prepare payload for creating/updating file
+            payload = {
+                'message': f'Update {file_path} ({message_count} messages)',
+                'content': base64.b64encode(content.encode()).decode(),
+                'branch': 'master'  # Explicitly set to master
+            }
+            
+            # Reuse the SHA from our last PUT; a new file needs none
+            if file_path in self.file_shas:
+                payload['sha'] = self.file_shas[file_path]
+            
+            put_response = self._put_file(url, payload)
+            
+            # 409/422 mean our SHA is stale or the file already exists: read it and retry once
+            if put_response.status_code in [409, 422]:
+                logger.info('stale sha repository=%s file=%s status=%s', self.repository_name, file_path, put_response.status_code)
+                sha = self._fetch_sha(file_path, url)
+                if sha is None:
+                    payload.pop('sha', None)
                 else:
-                    print(f"❌ GitHub API Error: {put_response.text}")
-                    return False
+                    payload['sha'] = sha
+                put_response = self._put_file(url, payload)
             
-            except requests.exceptions.RequestException as e:
-                print(f"❌ Network Error: {e}")
+            # Check for successful response
+            if put_response.status_code in [200, 201]:
+                sha = self._response_sha(put_response)
+                if sha is not None:
+                    self.file_shas[file_path] = sha
+                logger.info('pushed repository=%s file=%s messages=%d', self.repository_name, file_path, message_count)
+                return True
+            else:
+                self.file_shas.pop(file_path, None)
+                logger.error('push rejected repository=%s file=%s status=%s', self.repository_name, file_path, put_response.status_code)
                 return False
         
-        except Exception as e:
-            print(f"❌ Unexpected error pushing messages: {e}")
-            import traceback
-            traceback.print_exc()
+        except requests.exceptions.RequestException as e:
+            logger.error('push network error repository=%s file=%s error=%s', self.repository_name, file_path, e)
             return False
 
-class MessageHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.database = Database()
-        self.repo_manager = RepositoryManager(
+    def _put_file(self, url, payload):
+        data = json.dumps(payload)
+        response = self._request('put', url, data=data)
+        GITHUB_BYTES_PUSHED.inc(amount=len(data))
+        return response
+
+    def _request(self, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = getattr(self.session, method)(url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            GITHUB_RESPONSES.inc(method, 'error')
+            raise
+        finally:
+            GITHUB_REQUEST_SECONDS.observe(time.perf_counter() - started, method)
+        GITHUB_RESPONSES.inc(method, str(response.status_code))
+        self.rate_limit.update(response.status_code, response.headers)
+        return response
+
+    def _fetch_sha(self, file_path, url):
+        headers = {}
+        cached = self._etags.get(file_path)
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        get_response = self._request('get', url, headers=headers)
+        
+        # 304 answers do not count against the rate limit
+        if get_response.status_code == 304 and cached:
+            return cached[1]
+        if get_response.status_code == 200:
+            sha = get_response.json()['sha']
+            etag = get_response.headers.get('ETag')
+            if etag:
+                self._etags[file_path] = (etag, sha)
+            return sha
+        self._etags.pop(file_path, None)
+        return None
+
+    def history_files(self, branch='master'):
+        # Every markdown file holding messages, from a single tree listing.
+        # Their blob SHAs are remembered so the next push to them skips a GET.
+        url = f'{self.api_url}/repos/{self.github_username}/{self.repository_name}/git/trees/{branch}'
+        response = self._request('get', url, params={'recursive': '1'})
+        if response.status_code == 404:
+            return []
+        response.raise_for_status()
+        tree = response.json()
+        if tree.get('truncated'):
+            logger.warning('tree listing truncated repository=%s', self.repository_name)
+        paths = []
+        for entry in tree.get('tree', []):
+            path = entry['path']
+            if entry.get('type') != 'blob':
+                continue
+            if self._is_history_file(path):
+                self.file_shas.setdefault(path, entry['sha'])
+                paths.append(path)
+        return sorted(paths)
+
+    def iter_file_lines(self, file_path, chunk_size=64 * 1024):
+        # Streams a file's raw content line by line; large histories are
+        # never held in memory whole
+        response = self._request(
+            'get', self._contents_url(file_path),
+            headers={'Accept': 'application/vnd.github.raw'}, stream=True
+        )
+        with response:
+            if response.status_code == 404:
+                return
+            response.raise_for_status()
+            response.encoding = 'utf-8'
+            yield from _split_lines(response.iter_content(chunk_size, decode_unicode=True))
+
+    def _response_sha(self, response):
+        try:
+            return response.json()['content']['sha']
+        except (ValueError, KeyError, TypeError):
+            return None
+
+def _git_blob_sha(content):
+    # The object id git gives content stored as a blob
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+class GitMirrorBackend(SyncBackend):
+    # Commits shards to a local bare git repository: each push is a single
+    # commit however many shards it touches, written by one git fast-import.
+    # Remotes are brought up to date with native git push every
+    # push_interval seconds, so they receive one pack per interval instead
+    # of one API call per shard. Messages are committed until the commit
+    # holding them reaches every remote, then synced.
+    committer = 'Chat Server <chat-server@localhost>'
+
+    def __init__(self, mirror_path, repository_name, remotes=(), branch='master', push_interval=60.0,
+                 shard_by='day', shard_size=1000, shard_dir='chat_messages'):
+        super().__init__(repository_name, shard_by, shard_size, shard_dir)
+        self.mirror_path = mirror_path
+        self.remotes = list(remotes)
+        self.branch = branch
+        self.ref = f'refs/heads/{branch}'
+        self.push_interval = push_interval
+        # Tip of the branch and the blob SHA of every history file in it,
+        # read from the mirror on first use and kept current by our commits
+        self.head = None
+        self.file_shas = None
+        # Remote -> commit it was last pushed successfully
+        self.pushed = {}
+        self._pusher = None
+
+    @property
+    def location(self):
+        return self.mirror_path
+
+    def start(self):
+        if self.remotes and self._pusher is None:
+            self._pusher = MirrorPusher(self, self.push_interval)
+            self._pusher.start()
+
+    def stop(self, timeout=None):
+        if self._pusher is not None:
+            self._pusher.stop(timeout)
+            self._pusher = None
+
+    def unpublished_commit(self):
+        # Without remotes the mirror is the destination
+        return self.head if self.remotes else None
+
+    def includes(self, head, commit):
+        if commit == head:
+            return True
+        return self._git('merge-base', '--is-ancestor', commit, head, check=False).returncode == 0
+
+    def _git(self, *args, input=None, check=True):
+        # Never prompt for credentials; a push that needs them fails instead
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        return subprocess.run(
+            ['git', '--git-dir', self.mirror_path, *args],
+            input=input, capture_output=True, check=check, env=env
+        )
+
+    def _load(self):
+        # Created lazily so that only the process that syncs touches the mirror
+        if not os.path.exists(os.path.join(self.mirror_path, 'HEAD')):
+            subprocess.run(
+                ['git', 'init', '--quiet', '--bare', f'--initial-branch={self.branch}', self.mirror_path],
+                capture_output=True, check=True
+            )
+        result = self._git('rev-parse', '--verify', '--quiet', self.ref + '^{commit}', check=False)
+        self.head = result.stdout.decode().strip() or None
+        if self.head is None:
+            # A new mirror builds on the history the remotes already hold
+            for remote in self.remotes:
+                tip = self._fetch(remote)
+                if tip is not None:
+                    self._git('update-ref', self.ref, tip)
+                    self.head = self.pushed[remote] = tip
+                    break
+        self.file_shas = {}
+        if self.head is None:
+            return
+        listing = self._git('ls-tree', '-r', '-z', self.head).stdout.decode()
+        for entry in listing.split('\0'):
+            if not entry:
+                continue
+            meta, path = entry.split('\t', 1)
+            _, kind, sha = meta.split()
+            if kind == 'blob' and self._is_history_file(path):
+                self.file_shas[path] = sha
+
+    def _push_messages(self, messages):
+        try:
+            if not messages:
+                logger.warning('push skipped repository=%s reason=no_messages', self.repository_name)
+                return False
+            if self.file_shas is None:
+                self._load()
+            # Shards whose rendering matches the committed blob are left out
+            changed = {}
+            for file_path, shard_messages in self._shards(messages).items():
+                content = self.render_shard(shard_messages).encode()
+                sha = _git_blob_sha(content)
+                if self.file_shas.get(file_path) != sha:
+                    changed[file_path] = (content, sha)
+            if changed:
+                self._commit(changed, len(messages))
+                logger.info('committed repository=%s files=%d messages=%d',
+                            self.repository_name, len(changed), len(messages))
+            return True
+        except (OSError, subprocess.CalledProcessError) as e:
+            stderr = getattr(e, 'stderr', None)
+            logger.error('commit failed repository=%s error=%s %s', self.repository_name, e,
+                         stderr.decode(errors='replace').strip() if stderr else '')
+            # The branch may have moved under us; read it again before the retry
+            self.file_shas = None
+            return False
+
+    def _commit(self, files, message_count):
+        message = f'Update {len(files)} files ({message_count} messages)'.encode()
+        stream = [
+            b'commit %s\n' % self.ref.encode(),
+            b'committer %s %d +0000\n' % (self.committer.encode(), int(time.time())),
+            b'data %d\n%s\n' % (len(message), message)
+        ]
+        # fast-import refuses to move the branch unless it descends from head
+        if self.head is not None:
+            stream.append(b'from %s\n' % self.head.encode())
+        for file_path, (content, _) in sorted(files.items()):
+            stream.append(b'M 100644 inline %s\ndata %d\n%s\n' % (file_path.encode(), len(content), content))
+        stream.append(b'done\n')
+        self._git('fast-import', '--quiet', '--done', input=b''.join(stream))
+        self.head = self._git('rev-parse', self.ref).stdout.decode().strip()
+        for file_path, (_, sha) in files.items():
+            self.file_shas[file_path] = sha
+
+    def _fetch(self, remote):
+        # Fetches the remote's branch; returns its tip, or None if the remote
+        # cannot be reached or has no such branch yet
+        result = self._git('fetch', '--quiet', '--no-tags', remote, self.ref, check=False)
+        if result.returncode != 0:
+            logger.warning('fetch failed repository=%s remote=%s error=%s', self.repository_name, remote,
+                           result.stderr.decode(errors='replace').strip())
+            return None
+        return self._git('rev-parse', 'FETCH_HEAD').stdout.decode().strip()
+
+    def _merge_remote(self, remote):
+        # Commits on top of both the remote's tip and our head, with the
+        # remote's tree and our history files over it, so that pushing it is
+        # a fast-forward and every commit made so far stays an ancestor.
+        # Returns the new head, or None when there is nothing to merge.
+        with self._lock:
+            tip = self._fetch(remote)
+            if tip is None or self.head is None or self.includes(self.head, tip):
+                return None
+            message = b'Merge remote history'
+            stream = [
+                b'commit %s\n' % self.ref.encode(),
+                b'committer %s %d +0000\n' % (self.committer.encode(), int(time.time())),
+                b'data %d\n%s\n' % (len(message), message),
+                b'from %s\n' % tip.encode(),
+                b'merge %s\n' % self.head.encode()
+            ]
+            for file_path, sha in sorted(self.file_shas.items()):
+                stream.append(b'M 100644 %s %s\n' % (sha.encode(), file_path.encode()))
+            stream.append(b'done\n')
+            self._git('fast-import', '--quiet', '--done', input=b''.join(stream))
+            # Picks up the history files that only the remote had
+            self._load()
+            logger.info('merged repository=%s remote=%s commit=%s', self.repository_name, remote, tip[:12])
+            return self.head
+
+    def push_remotes(self):
+        # Pushes the branch to every remote that is behind it; returns
+        # whether all of them are now up to date
+        with self._lock:
+            if self.file_shas is None:
+                self._load()
+            head = self.head
+        if head is None:
+            return True
+        for remote in self.remotes:
+            if self.pushed.get(remote) == head:
+                continue
+            result = self._git('push', '--quiet', remote, f'{head}:{self.ref}', check=False)
+            if result.returncode != 0:
+                # Usually the remote has moved on: build on its tip and retry
+                merged = self._merge_remote(remote)
+                if merged is not None:
+                    head = merged
+                    result = self._git('push', '--quiet', remote, f'{head}:{self.ref}', check=False)
+            if result.returncode == 0:
+                self.pushed[remote] = head
+                logger.info('pushed repository=%s remote=%s commit=%s', self.repository_name, remote, head[:12])
+            else:
+                logger.error('push rejected repository=%s remote=%s error=%s', self.repository_name, remote,
+                             result.stderr.decode(errors='replace').strip())
+        # Every fast-import leaves a small pack; fold them together now and then
+        self._git('gc', '--auto', '--quiet', check=False)
+        # A merge moves the head past remotes pushed earlier in the loop;
+        # they are brought up to date on the next round
+        success = all(self.pushed.get(remote) == head for remote in self.remotes)
+        if success:
+            for listener in self._publish_listeners:
+                listener(self, head)
+        return success
+
+    def history_files(self):
+        with self._lock:
+            if self.file_shas is None:
+                self._load()
+            return sorted(self.file_shas)
+
+    def iter_file_lines(self, file_path):
+        blob = self.file_shas.get(file_path) if self.file_shas else None
+        if blob is None:
+            return
+        process = subprocess.Popen(
+            ['git', '--git-dir', self.mirror_path, 'cat-file', 'blob', blob], stdout=subprocess.PIPE
+        )
+        with process:
+            yield from io.TextIOWrapper(process.stdout, encoding='utf-8', newline='\n')
+
+# Pushes a GitMirrorBackend's commits to its remotes every interval
+# seconds, and once more on stop so the last commits are not left behind
+class MirrorPusher(threading.Thread):
+    def __init__(self, backend, interval):
+        super().__init__(name='git-mirror-push', daemon=True)
+        self.backend = backend
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            stopping = self._stopping.wait(self.interval)
+            try:
+                self.backend.push_remotes()
+            except Exception:
+                logger.exception('mirror push failed repository=%s', self.backend.repository_name)
+            if stopping:
+                return
+
+# One repository that messages are routed to, with its own client, push
+# schedule and in-flight flag so targets never wait on each other
+class SyncTarget:
+    def __init__(self, name, repo_manager, scheduler=None):
+        self.name = name
+        self.repo_manager = repo_manager
+        self.scheduler = scheduler or PushScheduler()
+        self.lock = threading.Lock()
+        self.in_flight = False
+
+    def next_delay(self):
+        return self.scheduler.next_delay(self.repo_manager.rate_limit)
+
+    def status(self):
+        return {
+            'repository': self.repo_manager.location,
+            'in_flight': self.in_flight,
+            'rate_limit': self.repo_manager.rate_limit.snapshot(),
+            'scheduler': self.scheduler.snapshot()
+        }
+
+# Routes each message to a SyncTarget by its repository column. Messages for
+# repositories that are not configured go to the default target.
+class RepositoryRegistry:
+    def __init__(self):
+        self.targets = {}
+        self.default_name = None
+
+    def add(self, name, repo_manager, scheduler=None, default=False):
+        target = self.targets[name] = SyncTarget(name, repo_manager, scheduler)
+        if default or self.default_name is None:
+            self.default_name = name
+        return target
+
+    def resolve(self, repository):
+        return self.targets.get(repository) or self.targets[self.default_name]
+
+    def __iter__(self):
+        return iter(self.targets.values())
+
+    @classmethod
+    def from_env(cls):
+        # REPOSITORIES is a comma separated list of "name" (a repository owned
+        # by GITHUB_USERNAME) or "name=owner/repository" entries
+        registry = cls()
+        username = os.getenv('GITHUB_USERNAME')
+        default_name = os.getenv('REPOSITORY_NAME')
+        entries = [entry.strip() for entry in os.getenv('REPOSITORIES', '').split(',') if entry.strip()]
+        if not entries:
+            entries = [default_name or '']
+        for entry in entries:
+            name, _, location = entry.partition('=')
+            owner, _, repository = location.rpartition('/') if location else ('', '', name)
+            registry.add(name, _backend_from_env(owner or username, repository), PushScheduler(
+                debounce=float(os.getenv('SYNC_DEBOUNCE', '2')),
+                backoff_max=float(os.getenv('SYNC_BACKOFF_MAX', '300'))
+            ), default=name == default_name)
+        return registry
+
+def _backend_from_env(owner, repository):
+    # SYNC_BACKEND picks the GitHub contents API (github) or a local git
+    # mirror pushed to GIT_REMOTES (git); remote URLs may name {owner} and
+    # {repository}
+    kind = os.getenv('SYNC_BACKEND', 'github')
+    shard_by = os.getenv('SHARD_BY', 'day')
+    shard_size = int(os.getenv('SHARD_SIZE', '1000'))
+    if kind == 'github':
+        return RepositoryManager(
             os.getenv('GITHUB_TOKEN'),
-            os.getenv('GITHUB_USERNAME'),
-            os.getenv('REPOSITORY_NAME')
+            owner,
+            repository,
+            shard_by=shard_by,
+            shard_size=shard_size,
+            api_url=os.getenv('GITHUB_API_URL', 'https://api.github.com')
         )
+    if kind == 'git':
+        remotes = [
+            url.strip().format(owner=owner or '', repository=repository)
+            for url in os.getenv('GIT_REMOTES', '').split(',') if url.strip()
+        ]
+        return GitMirrorBackend(
+            os.path.join(os.getenv('GIT_MIRROR_DIR', 'mirrors'), owner or '', f'{repository or "default"}.git'),
+            repository,
+            remotes=remotes,
+            push_interval=float(os.getenv('GIT_PUSH_INTERVAL', '60')),
+            shard_by=shard_by,
+            shard_size=shard_size
+        )
+    raise ValueError(f"SYNC_BACKEND must be 'github' or 'git', not {kind!r}")
+
+def parse_chat_markdown(lines):
+    # Streams (timestamp, content) pairs out of markdown written by
+    # render_shard, one section at a time. A content line that itself starts
+    # with "## " cannot be told apart from a header and begins a new section.
+    timestamp, content = None, []
+    for line in lines:
+        if line.endswith('\n'):
+            line = line[:-1]
+        if line.startswith('## '):
+            if timestamp is not None:
+                yield timestamp, _section_content(content)
+            timestamp, content = line[3:].strip(), []
+        elif timestamp is not None:
+            content.append(line)
+    if timestamp is not None:
+        yield timestamp, _section_content(content)
+
+def _section_content(lines):
+    # render_shard ends every section with a blank line
+    if lines and lines[-1] == '':
+        lines = lines[:-1]
+    return '\n'.join(lines)
+
+def _split_lines(chunks):
+    # Splits streamed text on '\n' only; str.splitlines would also break
+    # messages at '\r' and other separators
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+def _read_lines(path):
+    with open(path, encoding='utf-8', newline='\n') as f:
+        yield from f
+
+# Pushes outbox entries to their repositories in the background. Each target
+# is pushed on a worker pool, so a slow or rate limited repository does not
+# hold up the others. Every message committed while a target's push is in
+# flight is coalesced into that target's next single push, so POST /messages
+# never waits on GitHub.
+class SyncWorker(threading.Thread):
+    def __init__(self, registry, database=None, scheduler=None, max_workers=4):
+        super().__init__(name='github-sync', daemon=True)
+        if isinstance(registry, SyncBackend):
+            repo_manager, registry = registry, RepositoryRegistry()
+            registry.add(repo_manager.repository_name, repo_manager, scheduler)
+        self.registry = registry
+        self.database = database or get_database()
+        for target in registry:
+            target.repo_manager.add_publish_listener(self._published)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='github-sync')
+        self._wakeup = threading.Event()
+        # Pending entries left over from a previous run are picked up on start
+        self._wakeup.set()
+        self._stopping = threading.Event()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for target in self.registry:
+            target.repo_manager.stop(timeout)
+
+    def run(self):
+        for target in self.registry:
+            target.repo_manager.start()
+        timeout = None
+        while not self._stopping.is_set():
+            self._wakeup.wait(timeout)
+            # Everything committed during the debounce window is gathered
+            # into the next single push
+            debounce = max(target.scheduler.debounce for target in self.registry)
+            if debounce and self._stopping.wait(debounce):
+                break
+            self._wakeup.clear()
+            timeout = self._dispatch()
+
+    def _dispatch(self):
+        # Starts a push for every idle target that has pending messages and
+        # returns how long to wait before targets in backoff are ready
+        timeout = None
+        for target, pending in self._pending_by_target().items():
+            if target.in_flight:
+                # Its completion wakes the dispatcher again
+                continue
+            delay = target.next_delay()
+            if delay > 0:
+                timeout = delay if timeout is None else min(timeout, delay)
+                continue
+            target.in_flight = True
+            future = self.executor.submit(self._sync_target, target, pending)
+            future.add_done_callback(lambda _: self._wakeup.set())
+        return timeout
+
+    def _pending_by_target(self):
+        groups = {}
+        for msg in self.database.get_pending_sync_messages():
+            groups.setdefault(self.registry.resolve(msg['repository']), []).append(msg)
+        return groups
+
+    def sync(self, force=False):
+        # Pushes every target now, in parallel, and reports overall success
+        if force:
+            groups = {target: [] for target in self.registry}
+            groups.update(self._pending_by_target())
+        else:
+            groups = self._pending_by_target()
+        futures = [
+            self.executor.submit(self._sync_target, target, pending, force)
+            for target, pending in groups.items()
+        ]
+        return all(future.result() for future in futures)
+
+    def _sync_target(self, target, pending, force=False):
+        database = self.database
+        with target.lock:
+            target.in_flight = True
+            try:
+                if force:
+                    messages = self._routed(target, database.get_messages())
+                else:
+                    messages = self._messages_in_pending_shards(target, pending)
+                if not messages:
+                    # An idle target in a forced push has nothing to write;
+                    # that is neither a success nor a failure of the repository
+                    return True
+                pending_ids = [msg['id'] for msg in pending]
+                try:
+                    success = target.repo_manager.push_messages(messages)
+                    error = None if success else 'Repository push failed'
+                except Exception as e:
+                    success, error = False, str(e)
+
+                if success:
+                    target.scheduler.record_success()
+                    commit = target.repo_manager.unpublished_commit()
+                    if commit is None:
+                        database.mark_synced(pending_ids)
+                    else:
+                        database.mark_committed(pending_ids, commit)
+                else:
+                    target.scheduler.record_failure()
+                    database.mark_sync_failed(pending_ids, error)
+                return success
+            finally:
+                target.in_flight = False
+
+    def _published(self, backend, head):
+        # Called on every successful remote push, including those with
+        # nothing new to send, so entries marked committed after the head
+        # was read are picked up by the next one
+        commits = [commit for commit in self.database.get_committed_commits() if backend.includes(head, commit)]
+        if commits:
+            self.database.mark_commits_synced(commits)
+
+    def _routed(self, target, messages):
+        return [msg for msg in messages if self.registry.resolve(msg['repository']) is target]
+
+    def _messages_in_pending_shards(self, target, pending):
+        # Whole shards are re-rendered, so load every row in each touched shard
+        ranges = {target.repo_manager.shard_range(msg) for msg in pending}
+        messages = []
+        for column, start, end in sorted(ranges):
+            messages.extend(self._routed(target, self.database.get_messages_in_range(column, start, end)))
+        return messages
+
+    def status(self):
+        # The outbox is shared by every worker process; push state lives
+        # only in the one whose sync worker runs
+        status = {
+            'pending': self.database.count_pending_sync(),
+            'committed': self.database.count_committed_sync(),
+            'leader': self.is_alive()
+        }
+        if status['leader']:
+            status['targets'] = {target.name: target.status() for target in self.registry}
+        return status
+
+# Moves messages older than max_age_days from the hot table into the
+# compressed archive, in batches of batch_size, once every interval seconds.
+# A repository shard is re-rendered whole from the hot table whenever one of
+# its messages is pushed, so only whole shards that have nothing waiting for
+# sync are archived: the cutoff is a UTC day boundary no later than the
+# oldest pending message, and count-sharded repositories also align the id
+# bound to their shard size.
+class RetentionWorker(threading.Thread):
+    def __init__(self, database, max_age_days, interval=3600.0, batch_size=1000, registry=None):
+        super().__init__(name='retention', daemon=True)
+        self.database = database
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.count_shard_sizes = sorted({
+            target.repo_manager.shard_size for target in (registry or ())
+            if target.repo_manager.shard_by == 'count'
+        })
+        self._stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.run_pass()
+            except sqlite3.Error:
+                logger.exception('retention pass failed')
+            self._stopping.wait(self.interval)
+
+    def bounds(self, now=None):
+        # (before_id, before_timestamp) of the rows that may be archived
+        now = now or datetime.now(timezone.utc)
+        cutoff = (now - timedelta(days=self.max_age_days)).strftime('%Y-%m-%d')
+        pending = self.database.get_oldest_pending_timestamp()
+        if pending is not None:
+            cutoff = min(cutoff, pending[:10])
+        before_id = self.database.get_first_id_since(cutoff) or self.database.get_latest_id() + 1
+        for shard_size in self.count_shard_sizes:
+            before_id = before_id // shard_size * shard_size
+        return before_id, cutoff
+
+    def run_pass(self):
+        # Each batch commits on its own so writers are never held up for long
+        before_id, cutoff = self.bounds()
+        archived = 0
+        while not self._stopping.is_set():
+            count = self.database.archive_messages(before_id, cutoff, self.batch_size)
+            archived += count
+            if count < self.batch_size:
+                break
+        if archived:
+            logger.info('archived messages=%d before=%s', archived, cutoff)
+        return archived
+
+# Runs on the sync leader the forced pushes that other worker processes
+# record in sync_requests. Requests that wait together share one push.
+class SyncRequestListener(threading.Thread):
+    def __init__(self, sync_worker, interval=0.2):
+        super().__init__(name='sync-requests', daemon=True)
+        self.sync_worker = sync_worker
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.poll()
+            except sqlite3.Error:
+                logger.exception('sync request poll failed')
+
+    def poll(self):
+        # Returns how many requests were served
+        database = self.sync_worker.database
+        request_ids = database.get_open_sync_requests()
+        if request_ids:
+            database.complete_sync_requests(request_ids, self.sync_worker.sync(force=True))
+        return len(request_ids)
+
+# Elects the one process that pushes to GitHub when several serve the same
+# database. The leader holds an exclusive flock on lock_path for as long as
+# it lives; the kernel drops the lock when it exits, and another process
+# takes over at its next attempt.
+class SyncLeaderElection(threading.Thread):
+    def __init__(self, lock_path, on_elected, retry_interval=1.0):
+        super().__init__(name='sync-leader', daemon=True)
+        self.lock_path = lock_path
+        self.on_elected = on_elected
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self._file = None
+        self._stopping = threading.Event()
+
+    def try_acquire(self):
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        self.is_leader = True
+        return True
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.is_alive():
+            self.join(timeout)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.is_leader = False
+
+    def run(self):
+        while not self._stopping.is_set():
+            if self.try_acquire():
+                logger.info('elected sync leader pid=%d', os.getpid())
+                self.on_elected()
+                return
+            self._stopping.wait(self.retry_interval)
+
+# Fans newly committed messages out to streaming and long-poll clients. The
+# most recent messages are kept in a bounded ring so that clients resuming
+# from a recent cursor are served without touching the database.
+class BroadcastHub:
+    def __init__(self, latest_id=0, capacity=1000):
+        self.latest_id = latest_id
+        self._recent = collections.deque(maxlen=capacity)
+        # Every message after _floor is in the ring
+        self._floor = latest_id
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def publish(self, messages):
+        with self._condition:
+            for message in messages:
+                if len(self._recent) == self._recent.maxlen:
+                    self._floor = self._recent[0]['id']
+                self._recent.append(message)
+                self.latest_id = max(self.latest_id, message['id'])
+            self._condition.notify_all()
+
+    def messages_after(self, after_id, limit):
+        # Returns None when the ring no longer covers the cursor
+        with self._condition:
+            if after_id < self._floor:
+                return None
+            messages = [message for message in self._recent if message['id'] > after_id]
+            return messages[:limit]
+
+    def wait_for(self, after_id, timeout):
+        # True once a message newer than after_id exists
+        with self._condition:
+            self._condition.wait_for(lambda: self.latest_id > after_id or self._closed, timeout)
+            return self.latest_id > after_id
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+# Follows commits made through any connection to the database file,
+# including other server processes, and hands the new rows to its
+# listeners in id order. SQLite serialises writers, so ids become visible
+# in commit order and following MAX(id) never skips a row. PRAGMA
+# data_version makes an idle check a single cheap statement.
+class ChangeFeed(threading.Thread):
+    def __init__(self, database, interval=0.05, batch_size=500):
+        super().__init__(name='change-feed', daemon=True)
+        self.database = database
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_id = database.get_latest_id()
+        self._listeners = []
+        self._data_version = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def wake(self):
+        # Local commits need not wait for the next poll
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.poll()
+            except sqlite3.Error:
+                logger.exception('change feed poll failed')
+
+    def poll(self):
+        data_version = self.database.conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        # Any commit, archiving included, may change what cached pages hold
+        self.database.version += 1
+        while True:
+            messages = self.database.get_messages(since_id=self.last_id, limit=self.batch_size)
+            if not messages:
+                return
+            self.last_id = messages[-1]['id']
+            for listener in self._listeners:
+                listener(messages)
+
+# Message ids of recently used idempotency keys, so a retried POST /messages
+# is answered from memory without reaching the writer. Least recently used
+# keys are dropped first; the database still maps them to their messages.
+class IdempotencyCache:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            message_id = self._entries.get(key)
+            if message_id is not None:
+                self._entries.move_to_end(key)
+            return message_id
+
+    def put(self, key, message_id):
+        with self._lock:
+            self._entries[key] = message_id
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+# Serialized GET /messages responses keyed on the database write version, so
+# polls between writes are answered from memory (or with 304) without
+# querying or re-encoding. Entries are evicted least recently used first once
+# max_entries or max_bytes is exceeded, and dropped wholesale when the
+# version moves on.
+class ResponseCache:
+    def __init__(self, max_entries=256, max_bytes=8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version, key):
+        with self._lock:
+            if version != self._version:
+                self._clear(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, version, key, entry):
+        body = entry[0]
+        # A single huge page would push out everything else
+        if len(body) > self.max_bytes // 4:
+            return
+        with self._lock:
+            if version != self._version:
+                self._clear(version)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[0])
+            self._entries[key] = entry
+            self.size += len(body)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted[0])
+
+    def _clear(self, version):
+        self._entries.clear()
+        self.size = 0
+        self._version = version
+
+# A static file held in memory with its precompressed variants
+class StaticAsset:
+    def __init__(self, file_path, content_type, body, mtime):
+        self.file_path = file_path
+        self.content_type = content_type
+        self.mtime = mtime
+        self.last_modified = formatdate(mtime, usegmt=True)
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        # Encoding -> (body, strong ETag); each variant has its own ETag
+        self.variants = {None: (body, f'"{digest}"')}
+        self.variants['gzip'] = (gzip.compress(body, compresslevel=9), f'"{digest}-gzip"')
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(body), f'"{digest}-br"')
+
+    def negotiate(self, accept_encoding):
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and _accepts_encoding(accept_encoding, encoding):
+                return encoding
+        return None
+
+# Serves static files from memory. Files are read and compressed once, and
+# reloaded when their mtime changes; the mtime is checked at most once per
+# check_interval seconds.
+class StaticAssetCache:
+    def __init__(self, files, check_interval=1.0):
+        # URL path -> (file path, content type)
+        self.files = files
+        self.check_interval = check_interval
+        self._assets = {}
+        self._checked_at = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        for url_path in self.files:
+            self.get(url_path)
+
+    def get(self, url_path):
+        if url_path not in self.files:
+            return None
+        now = time.monotonic()
+        asset = self._assets.get(url_path)
+        if asset is not None and now - self._checked_at[url_path] < self.check_interval:
+            return asset
+        with self._lock:
+            file_path, content_type = self.files[url_path]
+            mtime = os.stat(file_path).st_mtime
+            asset = self._assets.get(url_path)
+            if asset is None or asset.mtime != mtime:
+                with open(file_path, 'rb') as f:
+                    asset = StaticAsset(file_path, content_type, f.read(), mtime)
+                self._assets[url_path] = asset
+            self._checked_at[url_path] = now
+            return asset
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+# Largest page GET /messages returns when a cursor or limit is given
+MAX_PAGE_SIZE = 500
+
+def _instrumented(handler_method):
+    # Times a do_* method and counts its response status per route
+    method = handler_method.__name__[len('do_'):]
+
+    @functools.wraps(handler_method)
+    def wrapper(self):
+        self.response_status = None
+        started = time.perf_counter()
+        try:
+            return handler_method(self)
+        finally:
+            route = self._route_label(urlparse(self.path).path)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method, route)
+            HTTP_RESPONSES.inc(method, route, str(self.response_status))
+    return wrapper
+
+class MessageHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests, so every response
+    # must carry a Content-Length
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the body
+    disable_nagle_algorithm = True
+    # Idle keep-alive connections are dropped after this many seconds
+    timeout = 30
+    db_path = 'messages.db'
+    # Shared background sync worker, broadcast hub, group commit writer,
+    # response cache and idempotency keys, installed by run_server
+    sync_worker = None
+    hub = None
+    writer = None
+    response_cache = None
+    idempotency_keys = None
+    static_assets = StaticAssetCache({'/': ('index.html', 'text/html; charset=utf-8')})
+    # Each open stream holds a worker thread, so only some may be streams
+    stream_slots = threading.BoundedSemaphore(8)
+    # Waiting long-polls hold a worker thread too; clients fall back to them
+    # when the stream slots are taken, so they get their own smaller share
+    poll_slots = threading.BoundedSemaphore(4)
+    stream_heartbeat = 15
+    # Streams are recycled periodically; EventSource reconnects transparently
+    stream_max_duration = 300
+    long_poll_max_timeout = 60
+    # How long POST /push in a worker that is not the sync leader waits for
+    # the leader's push before answering 202
+    push_wait_timeout = 60
+
+    def __init__(self, *args, **kwargs):
+        self.database = get_database(self.db_path)
         super().__init__(*args, **kwargs)
 
+    def _send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload, headers=None):
+        self._send_body(status, 'application/json', json.dumps(payload).encode(), headers)
+
+    def log_request(self, code='-', size='-'):
+        # Called by send_response for every response, including errors
+        self.response_status = code
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s "%s" %s', self.address_string(), self.requestline, code)
+
+    def log_error(self, format, *args):
+        logger.info('%s ' + format, self.address_string(), *args)
+
+    def log_message(self, format, *args):
+        logger.debug('%s ' + format, self.address_string(), *args)
+
+    def _push(self):
+        sync_worker = self.sync_worker
+        if sync_worker is None:
+            self.send_error(503, 'Sync worker not running')
+            return
+        if sync_worker.is_alive():
+            success = sync_worker.sync(force=True)
+            self._send_json(200 if success else 500, {'success': success})
+            return
+        # With several worker processes only the elected leader pushes; the
+        # request is handed to it through the database
+        request_id = self.database.request_sync()
+        deadline = time.monotonic() + self.push_wait_timeout
+        while time.monotonic() < deadline:
+            success = self.database.get_sync_request(request_id)
+            if success is not None:
+                self._send_json(200 if success else 500, {'success': success})
+                return
+            time.sleep(0.1)
+        # Still queued or in progress; the leader will get to it
+        self._send_json(202, {'success': None})
+
+    def _route_label(self, path):
+        # Collapses request paths onto their routes so metric labels stay bounded
+        if path in ROUTES or path in self.static_assets.files:
+            return path
+        if re.fullmatch(r'/messages/\d+/sync', path):
+            return '/messages/<id>/sync'
+        return 'other'
+
+    def _get_messages_page(self, query):
+        since_id = _int_param(query, 'since_id')
+        before_id = _int_param(query, 'before_id')
+        limit = _int_param(query, 'limit')
+        filters = {
+            'repository': query.get('repository', [None])[0],
+            'start': _timestamp_param(query, 'start'),
+            'end': _timestamp_param(query, 'end')
+        }
+        if limit is not None:
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
+        elif since_id is not None or before_id is not None:
+            limit = MAX_PAGE_SIZE
+
+        messages = self.database.get_messages(since_id=since_id, before_id=before_id, limit=limit, **filters)
+
+        # X-Next-Cursor is the since_id that continues after this page;
+        # X-Prev-Cursor is the before_id of the next older page, if any
+        if messages:
+            headers = {'X-Next-Cursor': str(messages[-1]['id'])}
+        elif since_id is not None:
+            headers = {'X-Next-Cursor': str(since_id)}
+        elif before_id is not None:
+            headers = {'X-Next-Cursor': str(before_id - 1)}
+        else:
+            headers = {'X-Next-Cursor': '0'}
+        if since_id is None and limit is not None and messages:
+            if self.database.has_messages_before(messages[0]['id'], **filters):
+                headers['X-Prev-Cursor'] = str(messages[0]['id'])
+        return messages, headers
+
+    def _send_static_asset(self, url_path):
+        try:
+            asset = self.static_assets.get(url_path)
+        except OSError:
+            self.send_error(404)
+            return
+        encoding = asset.negotiate(self.headers.get('Accept-Encoding', ''))
+        body, etag = asset.variants[encoding]
+        headers = {
+            'ETag': etag,
+            'Last-Modified': asset.last_modified,
+            # Browsers keep the page but revalidate it on every visit
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            not_modified = _etag_matches(if_none_match, etag)
+        else:
+            not_modified = _not_modified_since(self.headers.get('If-Modified-Since'), asset.mtime)
+        if not_modified:
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        self._send_body(200, asset.content_type, body, headers)
+
+    def _send_messages_streaming(self, query):
+        # Rows are encoded and written as they come off the cursor, so memory
+        # stays flat however large the history is. HTTP/1.1 clients get
+        # chunked transfer encoding; older clients read until the close.
+        try:
+            since_id = _int_param(query, 'since_id') or 0
+            before_id = _int_param(query, 'before_id')
+            limit = _int_param(query, 'limit')
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if 'start' in query or 'end' in query:
+            self.send_error(400, 'start and end are not supported when streaming')
+            return
+        ndjson = query.get('format', [''])[0] == 'ndjson'
+        repository = query.get('repository', [None])[0]
+        rows = self.database.iter_messages(since_id, before_id, limit, repository=repository)
+
+        chunked = self.request_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson' if ndjson else 'application/json')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+        out = _StreamWriter(self.wfile, chunked)
+        try:
+            if ndjson:
+                for row in rows:
+                    out.write(json.dumps(row) + '\n')
+            else:
+                out.write('[')
+                separator = ''
+                for row in rows:
+                    out.write(separator + json.dumps(row))
+                    separator = ', '
+                out.write(']')
+            out.close()
+        except (ConnectionError, OSError):
+            # The client went away mid-stream; the chunked body is left unterminated
+            self.close_connection = True
+        finally:
+            rows.close()
+
+    def _send_messages_page(self, query_string):
+        query = parse_qs(query_string)
+        if query.get('stream', [''])[0] in ('1', 'true') or query.get('format', [''])[0] == 'ndjson':
+            self._send_messages_streaming(query)
+            return
+        encoding = 'gzip' if _accepts_encoding(self.headers.get('Accept-Encoding', ''), 'gzip') else None
+        # Read the version before querying so a concurrent write can only
+        # make the cached page newer than its key, never older
+        version = self.database.version
+        key = (tuple(sorted((name, tuple(values)) for name, values in query.items())), encoding)
+        cache = self.response_cache
+        entry = cache.get(version, key) if cache is not None else None
+
+        if entry is None:
+            try:
+                messages, headers = self._get_messages_page(query)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            body = json.dumps(messages).encode()
+            headers['Vary'] = 'Accept-Encoding'
+            headers['Cache-Control'] = 'no-cache'
+            # The ETag hashes the JSON, not the gzip stream, whose header
+            # carries the compression time; like the static assets, each
+            # encoding gets its own tag
+            digest = hashlib.sha256(body).hexdigest()[:32]
+            if encoding and len(body) >= GZIP_MIN_SIZE:
+                body = gzip.compress(body, compresslevel=5)
+                headers['Content-Encoding'] = 'gzip'
+                digest += '-gzip'
+            headers['ETag'] = f'"{digest}"'
+            entry = (body, headers)
+            if cache is not None:
+                cache.put(version, key, entry)
+
+        body, headers = entry
+        if _etag_matches(self.headers.get('If-None-Match'), headers['ETag']):
+            self.send_response(304)
+            for name in ('ETag', 'Cache-Control', 'Vary'):
+                self.send_header(name, headers[name])
+            self.end_headers()
+            return
+        self._send_body(200, 'application/json', body, headers)
+
+    def _search_messages(self, query):
+        terms = query.get('q', [''])[0]
+        try:
+            limit = _int_param(query, 'limit')
+            offset = _int_param(query, 'offset') or 0
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if not terms.strip():
+            self.send_error(400, 'q is required')
+            return
+        limit = max(1, min(limit or 50, MAX_PAGE_SIZE))
+        repository = query.get('repository', [None])[0]
+
+        results = self.database.search_messages(_fts_query(terms), repository, limit, offset)
+        headers = {}
+        if len(results) == limit:
+            headers['X-Next-Offset'] = str(offset + limit)
+        self._send_json(200, results, headers)
+
+    def _send_archived_messages(self, query):
+        try:
+            since_id = _int_param(query, 'since_id')
+            before_id = _int_param(query, 'before_id')
+            limit = _int_param(query, 'limit')
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        limit = max(1, min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE))
+
+        messages = self.database.get_archived_messages(since_id, before_id, limit)
+        headers = {}
+        if messages:
+            headers['X-Next-Cursor'] = str(messages[-1]['id'])
+            if since_id is None and self.database.has_archived_messages_before(messages[0]['id']):
+                headers['X-Prev-Cursor'] = str(messages[0]['id'])
+        self._send_json(200, messages, headers)
+
+    def _messages_after(self, hub, cursor):
+        messages = hub.messages_after(cursor, MAX_PAGE_SIZE)
+        if messages is None:
+            messages = self.database.get_messages(since_id=cursor, limit=MAX_PAGE_SIZE)
+        return messages
+
+    def _stream_cursor(self, hub, query):
+        # A reconnecting EventSource sends Last-Event-ID; new clients may pass since_id
+        last_event_id = self.headers.get('Last-Event-ID')
+        if last_event_id:
+            if not last_event_id.isdigit():
+                raise ValueError('Last-Event-ID must be a message id')
+            return int(last_event_id)
+        since_id = _int_param(query, 'since_id')
+        return hub.latest_id if since_id is None else since_id
+
+    def _stream_messages(self, query):
+        # The stream outlives most requests; hold on to one hub throughout
+        hub = self.hub
+        if hub is None:
+            self.send_error(503, 'Live updates not available')
+            return
+        try:
+            cursor = self._stream_cursor(hub, query)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if not self.stream_slots.acquire(blocking=False):
+            # Clients fall back to long-polling
+            self.send_error(503, 'Too many open streams')
+            return
+
+        try:
+            # The stream ends when the connection closes
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'retry: 3000\n\n')
+
+            deadline = time.monotonic() + self.stream_max_duration
+            while not hub.closed and time.monotonic() < deadline:
+                messages = self._messages_after(hub, cursor)
+                if messages:
+                    events = ''.join(
+                        f"id: {msg['id']}\ndata: {json.dumps(msg)}\n\n" for msg in messages
+                    )
+                    self.wfile.write(events.encode())
+                    cursor = messages[-1]['id']
+                elif not hub.wait_for(cursor, self.stream_heartbeat):
+                    self.wfile.write(b': keep-alive\n\n')
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.stream_slots.release()
+
+    def _long_poll_messages(self, query):
+        hub = self.hub
+        if hub is None:
+            self.send_error(503, 'Live updates not available')
+            return
+        try:
+            cursor = _int_param(query, 'since_id')
+            timeout = _int_param(query, 'timeout')
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        cursor = hub.latest_id if cursor is None else cursor
+        timeout = min(25 if timeout is None else timeout, self.long_poll_max_timeout)
+
+        # A poll that can be answered straight away needs no slot
+        if hub.latest_id <= cursor and timeout > 0:
+            if not self.poll_slots.acquire(blocking=False):
+                # Clients retry after a pause
+                self.send_error(503, 'Too many open long-polls')
+                return
+            try:
+                hub.wait_for(cursor, timeout)
+            finally:
+                self.poll_slots.release()
+        messages = self._messages_after(hub, cursor)
+        next_cursor = messages[-1]['id'] if messages else cursor
+        self._send_json(200, messages, {'X-Next-Cursor': str(next_cursor)})
+
+    @_instrumented
     def do_GET(self):
         parsed_path = urlparse(self.path)
         
-        if parsed_path.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            with open('index.html', 'rb') as f:
-                self.wfile.write(f.read())
+        if parsed_path.path in self.static_assets.files:
+            self._send_static_asset(parsed_path.path)
         
         elif parsed_path.path == '/messages':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            messages = self.database.get_messages()
-            self.wfile.write(json.dumps(messages).encode())
+            self._send_messages_page(parsed_path.query)
+        
+        elif parsed_path.path == '/messages/stream':
+            self._stream_messages(parse_qs(parsed_path.query))
+        
+        elif parsed_path.path == '/messages/poll':
+            self._long_poll_messages(parse_qs(parsed_path.query))
+        
+        elif parsed_path.path == '/messages/search':
+            self._search_messages(parse_qs(parsed_path.query))
+        
+        elif parsed_path.path == '/messages/archive':
+            self._send_archived_messages(parse_qs(parsed_path.query))
+        
+        elif parsed_path.path == '/metrics':
+            self._send_body(200, METRICS_CONTENT_TYPE, metrics.render().encode())
+        
+        elif parsed_path.path == '/sync/status':
+            if self.sync_worker is None:
+                self.send_error(503, 'Sync worker not running')
+            else:
+                self._send_json(200, self.sync_worker.status())
+        
+        elif re.fullmatch(r'/messages/\d+/sync', parsed_path.path):
+            message_id = int(parsed_path.path.split('/')[2])
+            status = self.database.get_sync_status(message_id)
+            if status is None:
+                self.send_error(404, 'Message not found')
+            else:
+                self._send_json(200, status)
         
         else:
             self.send_error(404)
 
+    @_instrumented
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length)
@@ -167,37 +2697,380 @@ class MessageHandler(http.server.SimpleHTTPRequestHandler):
         if self.path == '/messages':
             try:
                 message_data = json.loads(post_data.decode('utf-8'))
-                message_id = self.database.add_message(
-                    message_data['content'], 
-                    message_data.get('repository', 'default')
-                )
-                
-                # Automatically push messages to repository
-                messages = self.database.get_messages()
-                push_success = self.repo_manager.push_messages(messages)
-                
-                self.send_response(201 if push_success else 206)  # 206 if message added but push failed
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({
-                    'id': message_id, 
-                    'push_success': push_success
-                }).encode())
+                content, repository = _message_fields(message_data)
+                key = _idempotency_key(self.headers.get('Idempotency-Key') or message_data.get('idempotency_key'))
+                # A retry is answered with the original id; nothing is written or synced again
+                cache = self.idempotency_keys
+                message_id = cache.get(key) if cache is not None and key is not None else None
+                if message_id is None:
+                    if self.writer is not None:
+                        message_id = self.writer.submit(content, repository, key).result()
+                    else:
+                        message_id = self.database.add_message(content, repository, key)
+                    if cache is not None and key is not None:
+                        cache.put(key, message_id)
             except Exception as e:
                 self.send_error(400, f'Invalid message: {str(e)}')
+                return
+            
+            # The row is committed; the repository push happens in the background
+            self._send_json(201, {
+                'id': message_id, 
+                'sync_status': 'pending'
+            })
+        
+        elif self.path == '/messages/batch':
+            try:
+                messages = _parse_batch(
+                    post_data, self.headers.get('Content-Type', ''), self.headers.get('Idempotency-Key')
+                )
+            except ValueError as e:
+                self.send_error(400, f'Invalid batch: {str(e)}')
+                return
+            rows = self.database.add_messages(messages)
+            self._send_json(201, {
+                'ids': [row['id'] for row in rows],
+                'count': len(rows),
+                'sync_status': 'pending'
+            })
         
         elif self.path == '/push':
-            messages = self.database.get_messages()
-            success = self.repo_manager.push_messages(messages)
-            
-            self.send_response(200 if success else 500)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': success}).encode())
+            self._push()
         
         else:
             self.send_error(404)
 
+# Fixed routes reported under their own metric label
+ROUTES = frozenset((
+    '/messages', '/messages/stream', '/messages/poll', '/messages/search', '/messages/archive',
+    '/messages/batch', '/metrics', '/sync/status', '/push'
+))
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Largest number of messages accepted by POST /messages/batch
+MAX_BATCH_SIZE = 10000
+
+# Longest Idempotency-Key accepted
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+def _idempotency_key(value):
+    if value is None:
+        return None
+    if not isinstance(value, str) or not value or len(value) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise ValueError(f'idempotency key must be a string of 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters')
+    return value
+
+def _parse_batch(body, content_type, idempotency_key=None):
+    # Accepts a JSON array or NDJSON (one JSON object per line) and returns
+    # (content, repository, idempotency key) tuples; the whole batch is
+    # rejected if any item is bad. An Idempotency-Key for the whole batch
+    # gives item N the key "<key>:N" unless the item has its own.
+    text = body.decode('utf-8')
+    try:
+        if 'ndjson' in content_type or not text.lstrip().startswith('['):
+            items = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            items = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(str(e))
+    if not isinstance(items, list) or not items:
+        raise ValueError('expected a non-empty list of messages')
+    if len(items) > MAX_BATCH_SIZE:
+        raise ValueError(f'at most {MAX_BATCH_SIZE} messages per batch')
+
+    messages = []
+    for index, item in enumerate(items):
+        try:
+            content, repository = _message_fields(item)
+        except ValueError as e:
+            raise ValueError(f'item {index}: {e}')
+        key = _idempotency_key(item.get('idempotency_key'))
+        if key is None and idempotency_key is not None:
+            key = _idempotency_key(f'{idempotency_key}:{index}')
+        messages.append((content, repository, key))
+    return messages
+
+def _message_fields(data):
+    # (content, repository) of a posted message; anything but strings would
+    # only fail later, inside a transaction shared with other messages
+    if not isinstance(data, dict) or not isinstance(data.get('content'), str):
+        raise ValueError('content must be a string')
+    repository = data.get('repository', 'default')
+    if not isinstance(repository, str):
+        raise ValueError('repository must be a string')
+    return data['content'], repository
+
+# Gathers small writes into chunks of about buffer_size bytes, framing each
+# one for chunked transfer encoding when chunked is set
+class _StreamWriter:
+    def __init__(self, wfile, chunked, buffer_size=64 * 1024):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.buffer_size = buffer_size
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        data = text.encode()
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._size:
+            return
+        data = b''.join(self._parts)
+        self._parts, self._size = [], 0
+        if self.chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def close(self):
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+def _not_modified_since(if_modified_since, mtime):
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have one-second resolution
+    return int(mtime) <= since
+
+def _fts_query(terms):
+    # Quote every word so user input is matched literally instead of being
+    # parsed as FTS5 syntax; the words are ANDed together
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in terms.split())
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+def _accepts_encoding(accept_encoding, encoding):
+    # Whether an Accept-Encoding header allows encoding: listed by name, or
+    # covered by '*', with a q-value above zero
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, *params = item.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities.get(encoding, qualities.get('*', 0.0)) > 0
+
+def _int_param(query, name):
+    values = query.get(name)
+    if not values:
+        return None
+    try:
+        value = int(values[0])
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+    if value < 0:
+        raise ValueError(f'{name} must not be negative')
+    return value
+
+def _timestamp_param(query, name):
+    # ISO 8601 date or time, normalized to the UTC 'YYYY-MM-DD HH:MM:SS'
+    # text SQLite's CURRENT_TIMESTAMP stores so it compares as a string
+    values = query.get(name)
+    if not values:
+        return None
+    text = values[0].strip()
+    if text.endswith(('Z', 'z')):
+        text = text[:-1] + '+00:00'
+    try:
+        value = datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO 8601 timestamp')
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+class ThreadPoolHTTPServer(http.server.HTTPServer):
+    # Serves each connection on a bounded pool of worker threads. Once every
+    # worker is busy and max_pending connections are queued, the accept loop
+    # blocks and further clients wait in the kernel listen backlog.
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, max_workers=16, max_pending=64, reuse_port=False):
+        self.reuse_port = reuse_port
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='http')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def server_bind(self):
+        if self.reuse_port:
+            _enable_reuse_port(self.socket)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        self.executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class _AsyncioConnection:
+    # Socket stand-in handed to MessageHandler by AsyncioHTTPServer. The
+    # request has already been read by the event loop; responses are written
+    # back through the loop as the handler produces them, so streamed
+    # responses are not buffered.
+    def __init__(self, loop, writer, request_bytes):
+        self._loop = loop
+        self._writer = writer
+        self._request_bytes = request_bytes
+
+    def makefile(self, mode, bufsize=-1):
+        return io.BytesIO(self._request_bytes)
+
+    def sendall(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self._loop).result()
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockname(self):
+        return self._writer.get_extra_info('sockname')
+
+class AsyncioHTTPServer:
+    # Accepts connections and parses request framing on an asyncio event loop,
+    # then runs MessageHandler for each complete request on a bounded executor.
+    # Idle keep-alive connections cost no thread while they wait.
+    def __init__(self, server_address, handler_class, max_workers=16, idle_timeout=30, reuse_port=False):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.reuse_port = reuse_port
+        self.ready = threading.Event()
+        self._loop = None
+        self._stop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    def server_close(self):
+        pass
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        host, port = self.server_address
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='http')
+        # Bind IPv4 like TCPServer does; letting asyncio bind every address
+        # family would give each socket its own ephemeral port
+        server = await asyncio.start_server(
+            self._handle_connection, host or '0.0.0.0', port, reuse_address=True,
+            reuse_port=self.reuse_port or None
+        )
+        self.server_address = server.sockets[0].getsockname()[:2]
+        self._executor = executor
+        self.ready.set()
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                    length = re.search(rb'(?im)^content-length:\s*(\d+)\s*$', head)
+                    body = await reader.readexactly(int(length.group(1))) if length else b''
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+
+                connection = _AsyncioConnection(self._loop, writer, head + body)
+                await self._loop.run_in_executor(
+                    self._executor, self.handler_class, connection, client_address, self
+                )
+                if not _wants_keep_alive(head):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+def _wants_keep_alive(head):
+    request_line, _, headers = head.partition(b'\r\n')
+    connection = re.search(rb'(?im)^connection:\s*([\w-]+)', headers)
+    connection = connection.group(1).lower() if connection else b''
+    if request_line.rstrip().endswith(b'HTTP/1.1'):
+        return connection != b'close'
+    return connection == b'keep-alive'
+
+SERVER_MODES = ('threaded', 'asyncio', 'single')
+
+def _enable_reuse_port(sock):
+    # Lets every pre-forked worker bind its own listening socket to the same
+    # port; the kernel spreads incoming connections across them
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+def create_server(port, mode='threaded', workers=16, reuse_port=False):
+    if mode == 'threaded':
+        return ThreadPoolHTTPServer(("", port), MessageHandler, max_workers=workers, reuse_port=reuse_port)
+    if mode == 'asyncio':
+        return AsyncioHTTPServer(("", port), MessageHandler, max_workers=workers, reuse_port=reuse_port)
+    if mode == 'single':
+        server = socketserver.TCPServer(("", port), MessageHandler, bind_and_activate=False)
+        try:
+            if reuse_port:
+                _enable_reuse_port(server.socket)
+            server.server_bind()
+            server.server_activate()
+        except BaseException:
+            server.server_close()
+            raise
+        return server
+    raise ValueError(f"Unknown server mode {mode!r}; expected one of {', '.join(SERVER_MODES)}")
+
 def find_free_port():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind(('', 0))
@@ -205,20 +3078,239 @@ def find_free_port():
         port = s.getsockname()[1]
     return port
 
-def run_server(port=None):
+def start_services(database, workers=16, multiprocess=False):
+    # Creates the background services shared by every request, installs them
+    # on MessageHandler and starts them. Returns a function that stops them.
+    # With multiprocess, other processes write to the same database: new
+    # messages reach this process's clients through a ChangeFeed, and only
+    # the elected leader runs the sync worker.
+    sync_worker = SyncWorker(
+        RepositoryRegistry.from_env(),
+        database,
+        max_workers=int(os.getenv('SYNC_WORKERS', '4'))
+    )
+    retention_days = float(os.getenv('RETENTION_DAYS', '0'))
+    retention = RetentionWorker(
+        database,
+        retention_days,
+        interval=float(os.getenv('RETENTION_INTERVAL', '3600')),
+        batch_size=int(os.getenv('RETENTION_BATCH_SIZE', '1000')),
+        registry=sync_worker.registry
+    ) if retention_days > 0 else None
+
+    sync_requests = SyncRequestListener(sync_worker) if multiprocess else None
+
+    # Work that must run in one process only
+    def start_leader_services():
+        sync_worker.start()
+        if sync_requests is not None:
+            sync_requests.start()
+        if retention is not None:
+            retention.start()
+
+    if multiprocess:
+        feed = ChangeFeed(database, float(os.getenv('CHANGE_FEED_INTERVAL_MS', '50')) / 1000)
+        database.add_listener(lambda messages: feed.wake())
+        hub = BroadcastHub(feed.last_id)
+        source = feed
+        election = SyncLeaderElection(database.db_path + '.sync-leader', start_leader_services)
+    else:
+        feed = election = None
+        hub = BroadcastHub(database.get_latest_id())
+        source = database
+    source.add_listener(hub.publish)
+    # One wake-up per commit, however many messages it carried
+    source.add_listener(lambda messages: sync_worker.notify())
+    group_commit_window = float(os.getenv('GROUP_COMMIT_WINDOW_MS', '2')) / 1000
+    writer = GroupCommitWriter(database, group_commit_window) if group_commit_window > 0 else None
+
+    installed = ('db_path', 'sync_worker', 'hub', 'writer', 'response_cache', 'idempotency_keys', 'stream_slots',
+                 'poll_slots')
+    previous = {name: getattr(MessageHandler, name) for name in installed}
+    MessageHandler.db_path = database.db_path
+    MessageHandler.sync_worker = sync_worker
+    MessageHandler.hub = hub
+    MessageHandler.writer = writer
+    MessageHandler.response_cache = ResponseCache()
+    MessageHandler.idempotency_keys = IdempotencyCache()
+    MessageHandler.stream_slots = threading.BoundedSemaphore(max(1, workers // 2))
+    MessageHandler.poll_slots = threading.BoundedSemaphore(max(1, workers // 4))
+    MessageHandler.static_assets.load()
+    previous_queue_depth = SYNC_QUEUE_DEPTH.callback
+    SYNC_QUEUE_DEPTH.callback = database.count_pending_sync
+
+    if multiprocess:
+        feed.start()
+        election.start()
+    else:
+        start_leader_services()
+    if writer is not None:
+        writer.start()
+
+    def stop():
+        if writer is not None:
+            writer.stop(timeout=5)
+        if feed is not None:
+            feed.stop(timeout=5)
+        hub.close()
+        if sync_requests is not None:
+            sync_requests.stop(timeout=5)
+        sync_worker.stop(timeout=5)
+        if retention is not None:
+            retention.stop(timeout=5)
+        if election is not None:
+            election.stop(timeout=5)
+        for name, value in previous.items():
+            setattr(MessageHandler, name, value)
+        SYNC_QUEUE_DEPTH.callback = previous_queue_depth
+    return stop
+
+def restore_history(database, registry=None, paths=None, repository=None):
+    # Loads messages from local markdown files when paths are given, and
+    # otherwise from every history file of every configured repository.
+    # Safe to repeat: messages already in the database are skipped.
+    if paths:
+        repository = repository or os.getenv('REPOSITORY_NAME') or 'default'
+        sources = ((repository, parse_chat_markdown(_read_lines(path))) for path in paths)
+    else:
+        registry = registry or RepositoryRegistry.from_env()
+        sources = (
+            (target.name or 'default', parse_chat_markdown(target.repo_manager.iter_file_lines(path)))
+            for target in registry
+            for path in target.repo_manager.history_files()
+        )
+    started = time.perf_counter()
+    restored = database.restore_messages(sources)
+    logger.info('restored messages=%d seconds=%.2f', restored, time.perf_counter() - started)
+    return restored
+
+def serve(port, mode='threaded', workers=16, multiprocess=False):
+    stop_services = start_services(get_database(MessageHandler.db_path), workers, multiprocess)
+    try:
+        with create_server(port, mode, workers, reuse_port=multiprocess) as httpd:
+            logger.info('server listening on http://localhost:%d (Ctrl+C to stop)', port)
+            httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logger.exception('server failed')
+    finally:
+        stop_services()
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_prefork(port, processes, mode='threaded', workers=16, restart_delay=1.0):
+    # Forks processes workers that each bind port with SO_REUSEPORT, and
+    # replaces any that die until SIGINT or SIGTERM. The supervisor opens no
+    # database connections and starts no threads, so every child begins
+    # from a clean state.
+    if fcntl is None or not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('Multi-process mode needs fork, flock and SO_REUSEPORT')
+    children = {}
+    stopping = False
+
+    def spawn():
+        # Signals stay blocked across the fork until the child has its own
+        # handlers and the parent has recorded the pid; otherwise a SIGTERM
+        # in between would run the supervisor's handler in the child, or
+        # miss the new child altogether
+        stop_signals = {signal.SIGTERM, signal.SIGINT}
+        signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+                signal.signal(signal.SIGINT, _raise_keyboard_interrupt)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+                serve(port, mode, workers, multiprocess=True)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+        logger.info('started worker pid=%d', pid)
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    previous_handlers = {
+        signum: signal.signal(signum, shutdown) for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        for _ in range(processes):
+            spawn()
+        while children:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None or stopping:
+                continue
+            logger.warning('worker exited pid=%d status=%d, restarting', pid, status)
+            # A worker that dies straight away is likely to again; don't spin
+            if time.monotonic() - started < restart_delay:
+                time.sleep(restart_delay)
+            if not stopping:
+                spawn()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+def run_server(port=None, mode=None, workers=None, processes=None):
     if port is None:
         port = find_free_port()
+    mode = mode or os.getenv('SERVER_MODE', 'threaded')
+    workers = workers or int(os.getenv('SERVER_WORKERS', '16'))
+    processes = processes or int(os.getenv('SERVER_PROCESSES', '1'))
     
-    print(f"🚀 Attempting to start Chat Message Server on port {port}")
-    try:
-        with socketserver.TCPServer(("", port), MessageHandler) as httpd:
-            print(f"✅ Server successfully started on http://localhost:{port}")
-            print("Press Ctrl+C to stop the server.")
-            httpd.serve_forever()
-    except Exception as e:
-        print(f"❌ Failed to start server: {e}")
+    logger.info('starting server port=%d mode=%s workers=%d processes=%d', port, mode, workers, processes)
+    if processes > 1:
+        run_prefork(port, processes, mode, workers)
+    else:
+        serve(port, mode, workers)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Chat message server')
+    parser.add_argument('command', nargs='?', choices=('serve', 'restore'), default='serve',
+                        help='serve (default) or restore the message history into the database and exit')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--mode', choices=SERVER_MODES, help='defaults to SERVER_MODE or threaded')
+    parser.add_argument('--workers', type=int, help='request threads per process, defaults to SERVER_WORKERS or 16')
+    parser.add_argument('--processes', type=int, help='worker processes, defaults to SERVER_PROCESSES or 1')
+    parser.add_argument('--db', default=MessageHandler.db_path, help='SQLite database file')
+    parser.add_argument('--from-file', dest='paths', action='append', metavar='PATH',
+                        help='restore from a local markdown file instead of the repositories; repeatable')
+    parser.add_argument('--repository', help='repository recorded for messages restored from files')
+    parser.add_argument('--restore-if-empty', action='store_true',
+                        help='when serving, first restore the history if the database has no messages')
+    args = parser.parse_args(argv)
+    # INSERT ... RETURNING needs SQLite 3.35
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        parser.error(f'SQLite 3.35 or newer is required, found {sqlite3.sqlite_version}')
+
+    MessageHandler.db_path = args.db
+    if args.command == 'restore' or args.restore_if_empty:
+        # A private Database, closed before serving, so no connection is
+        # inherited by pre-forked workers
+        database = Database(args.db)
+        try:
+            if args.command == 'restore' or database.is_empty():
+                restore_history(database, paths=args.paths, repository=args.repository)
+        finally:
+            database.close()
+    if args.command == 'serve':
+        run_server(args.port, args.mode, args.workers, args.processes)
 
 if __name__ == "__main__":
-    port = 8090  # Explicitly set to 8090
-    print(f"🚀 Starting server on port {port}")
-    run_server(port)
+    logging.basicConfig(
+        level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s %(levelname)s %(name)s %(message)s'
+    )
+    main()
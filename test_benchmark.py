@@ -0,0 +1,92 @@
+import unittest
+import os
+import tempfile
+import sys
+import json
+import http.client
+import threading
+import shutil
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import benchmark
+
+class TestFakeGitHubAPI(unittest.TestCase):
+    def setUp(self):
+        self.api = benchmark.FakeGitHubAPI(rate_limit=2)
+        threading.Thread(target=self.api.serve_forever, daemon=True).start()
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.api.server_address[1], timeout=5)
+
+    def tearDown(self):
+        self.conn.close()
+        self.api.shutdown()
+        self.api.server_close()
+
+    def _put(self, payload):
+        self.conn.request('PUT', '/repos/o/r/contents/a.md', body=json.dumps(payload))
+        response = self.conn.getresponse()
+        return response, json.loads(response.read())
+
+    def test_put_requires_sha_and_enforces_quota(self):
+        response, body = self._put({'content': 'aGk='})
+        self.assertEqual(response.status, 201)
+        self.assertEqual(response.getheader('X-RateLimit-Remaining'), '1')
+
+        response, _ = self._put({'content': 'aGk='})
+        self.assertEqual(response.status, 422)
+        self.assertEqual(response.getheader('X-RateLimit-Remaining'), '0')
+
+        response, _ = self._put({'content': 'aGk=', 'sha': body['content']['sha']})
+        self.assertEqual(response.status, 403)
+        self.assertEqual(self.api.rate_limited, 1)
+
+class TestBenchmark(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 0.50), 50)
+        self.assertEqual(benchmark.percentile(values, 0.99), 99)
+        self.assertIsNone(benchmark.percentile([], 0.5))
+
+    def test_parse_mix(self):
+        self.assertEqual(benchmark.parse_mix('post=1,poll'), {'post': 1, 'poll': 1})
+        with self.assertRaises(Exception):
+            benchmark.parse_mix('delete=1')
+
+    def test_find_regressions(self):
+        baseline = {'endpoints': {'get': {'p95_ms': 10.0}, 'post': {'p95_ms': 10.0}}}
+        result = {'endpoints': {'get': {'p95_ms': 11.0}, 'post': {'p95_ms': 13.0}}}
+        regressions = benchmark.find_regressions(result, baseline, 0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('post'))
+
+    @patch.dict(os.environ, {'SYNC_DEBOUNCE': '0.05'})
+    def test_run_benchmark_reports_every_endpoint(self):
+        environ = dict(os.environ)
+        temp_dirs = []
+        mkdtemp = tempfile.mkdtemp
+        with patch('tempfile.mkdtemp', side_effect=lambda: temp_dirs.append(mkdtemp()) or temp_dirs[-1]):
+            result = benchmark.run_benchmark(duration=0.5, concurrency=2, workers=4, github_latency=0)
+        # The run leaves neither settings nor files behind
+        self.assertEqual(dict(os.environ), environ)
+        self.assertFalse(os.path.exists(temp_dirs[0]))
+
+        self.assertEqual(set(result['endpoints']), {'post', 'get', 'poll'})
+        for stats in result['endpoints'].values():
+            self.assertEqual(stats['errors'], 0)
+            self.assertGreater(stats['requests'], 0)
+            self.assertIsNotNone(stats['p95_ms'])
+        self.assertGreater(result['github']['requests'], 0)
+
+    @unittest.skipIf(shutil.which('git') is None, 'git is not installed')
+    @patch.dict(os.environ, {'SYNC_DEBOUNCE': '0.05'})
+    def test_run_benchmark_with_git_mirror(self):
+        result = benchmark.run_benchmark(duration=0.5, concurrency=2, workers=4, mix={'post': 1},
+                                         sync_backend='git', git_push_interval=0.1)
+
+        self.assertEqual(result['endpoints']['post']['errors'], 0)
+        self.assertEqual(result['github']['requests'], 0)
+        self.assertGreater(result['git']['remote_commits'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,14 @@ from unittest.mock import patch, MagicMock, Mock
 import io
 import socket
 import base64
+import threading
+import time
+import http.client
+import gzip
+import signal
+import subprocess
+import shutil
+from datetime import datetime, timezone
 
 # Add the project directory to the Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -22,8 +30,8 @@ class TestDatabase(unittest.TestCase):
         self.database = chat_server.Database(self.temp_db)
 
     def tearDown(self):
-        # Close the database connection and remove the temporary file
-        self.database.conn.close()
+        # Close the database connections and remove the temporary file
+        self.database.close()
         if os.path.exists(self.temp_db):
             os.unlink(self.temp_db)
 
@@ -48,6 +56,233 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(messages[0]['content'], "Message 1")
         self.assertEqual(messages[1]['content'], "Message 2")
 
+    def test_keyset_pagination(self):
+        ids = [self.database.add_message(f"Message {i}", "repo1") for i in range(5)]
+
+        page = self.database.get_messages(since_id=ids[1], limit=2)
+        self.assertEqual([msg['id'] for msg in page], ids[2:4])
+
+        # A bare limit returns the newest rows, still in ascending order
+        page = self.database.get_messages(limit=2)
+        self.assertEqual([msg['id'] for msg in page], ids[3:])
+
+        page = self.database.get_messages(before_id=ids[3], limit=2)
+        self.assertEqual([msg['id'] for msg in page], ids[1:3])
+        self.assertTrue(self.database.has_messages_before(ids[1]))
+        self.assertFalse(self.database.has_messages_before(ids[0]))
+
+    def _insert_at(self, rows):
+        # (content, repository, timestamp) rows, e.g. restored history whose
+        # timestamps are not in id order
+        with self.database.conn as conn:
+            conn.executemany('INSERT INTO messages (content, repository, timestamp) VALUES (?, ?, ?)', rows)
+        return [msg['id'] for msg in self.database.get_messages()]
+
+    def test_repository_filter(self):
+        ids = self._insert_at([
+            (f"Message {i}", "repo1" if i % 2 else "repo2", '2025-01-01 00:00:00') for i in range(6)
+        ])
+        repo1 = ids[1::2]
+
+        page = self.database.get_messages(repository="repo1")
+        self.assertEqual([msg['id'] for msg in page], repo1)
+        page = self.database.get_messages(repository="repo1", limit=2)
+        self.assertEqual([msg['id'] for msg in page], repo1[1:])
+        page = self.database.get_messages(repository="repo1", since_id=repo1[0], limit=1)
+        self.assertEqual([msg['id'] for msg in page], repo1[1:2])
+        self.assertTrue(self.database.has_messages_before(repo1[1], repository="repo1"))
+        self.assertFalse(self.database.has_messages_before(repo1[0], repository="repo1"))
+
+    def test_time_range_orders_by_timestamp_then_id(self):
+        ids = self._insert_at([
+            ("Tuesday", "repo1", '2025-01-07 09:00:00'),
+            ("Monday", "repo1", '2025-01-06 09:00:00'),
+            ("Monday again", "repo2", '2025-01-06 09:00:00'),
+            ("Wednesday", "repo1", '2025-01-08 09:00:00'),
+        ])
+        start, end = '2025-01-06 00:00:00', '2025-01-08 00:00:00'
+
+        page = self.database.get_messages(start=start, end=end)
+        self.assertEqual([msg['content'] for msg in page], ["Monday", "Monday again", "Tuesday"])
+
+        # Cursors are message ids, continuing in (timestamp, id) order
+        page = self.database.get_messages(start=start, end=end, limit=2)
+        self.assertEqual([msg['id'] for msg in page], [ids[2], ids[0]])
+        self.assertTrue(self.database.has_messages_before(ids[2], start=start, end=end))
+        page = self.database.get_messages(start=start, end=end, before_id=ids[2], limit=2)
+        self.assertEqual([msg['id'] for msg in page], [ids[1]])
+        self.assertFalse(self.database.has_messages_before(ids[1], start=start, end=end))
+        page = self.database.get_messages(start=start, since_id=ids[1], limit=2)
+        self.assertEqual([msg['id'] for msg in page], [ids[2], ids[0]])
+        page = self.database.get_messages(start=start, since_id=0, limit=1)
+        self.assertEqual([msg['id'] for msg in page], [ids[1]])
+
+        page = self.database.get_messages(repository="repo1", end=end)
+        self.assertEqual([msg['content'] for msg in page], ["Monday", "Tuesday"])
+
+    def test_query_plans_use_indexes(self):
+        self._insert_at([
+            (f"Message {i}", f"repo{i % 4}", f'2025-01-{i % 28 + 1:02d} 12:00:00') for i in range(2000)
+        ])
+        self.database.conn.execute('ANALYZE')
+        named = {'start': '2025-01-02 00:00:00', 'end': '2025-01-03 00:00:00',
+                 'repository': 'repo1', 'id': 100, 'limit': 50}
+        queries = [
+            (chat_server.SELECT_MESSAGES_AFTER_SQL, (100, chat_server.SQLITE_MAX_INT, 50)),
+            (chat_server.SELECT_MESSAGES_BEFORE_SQL, (100, 50)),
+            (chat_server.SELECT_REPOSITORY_MESSAGES_AFTER_SQL, ('repo1', 100, chat_server.SQLITE_MAX_INT, 50)),
+            (chat_server.SELECT_REPOSITORY_MESSAGES_BEFORE_SQL, ('repo1', 100, 50)),
+            (chat_server.SELECT_HAS_REPOSITORY_MESSAGES_BEFORE_SQL, ('repo1', 100)),
+            (chat_server.SELECT_MESSAGES_BY_TIME_AFTER_SQL, named),
+            (chat_server.SELECT_MESSAGES_BY_TIME_BEFORE_SQL, named),
+            (chat_server.SELECT_HAS_MESSAGES_BEFORE_TIME_SQL, named),
+        ]
+        for sql, params in queries:
+            plan = [row[3] for row in self.database.conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+            with self.subTest(sql=sql):
+                # Neither a sort of the result nor a walk of the whole table
+                self.assertFalse([step for step in plan if 'TEMP B-TREE' in step], plan)
+                self.assertFalse([step for step in plan if step.startswith('SCAN messages')], plan)
+
+    def test_add_messages_in_one_transaction(self):
+        commits = []
+        self.database.add_listener(commits.append)
+        first_id = self.database.add_message("Single", "repo1")
+        rows = self.database.add_messages([("Bulk 1", "repo1"), ("Bulk 2", "repo2")])
+
+        self.assertEqual([row['id'] for row in rows], [first_id + 1, first_id + 2])
+        self.assertEqual([row['content'] for row in rows], ["Bulk 1", "Bulk 2"])
+        self.assertEqual(self.database.get_pending_sync(), [first_id, first_id + 1, first_id + 2])
+        # Listeners hear about the batch once
+        self.assertEqual(len(commits), 2)
+        self.assertEqual(commits[1], rows)
+
+    def test_group_commit_writer_batches_concurrent_inserts(self):
+        commits = []
+        self.database.add_listener(commits.append)
+        writer = chat_server.GroupCommitWriter(self.database, window=0.2)
+        futures = [writer.submit(f"Message {i}", "repo1") for i in range(5)]
+        writer.start()
+        try:
+            ids = [future.result(5) for future in futures]
+        finally:
+            writer.stop(timeout=5)
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(ids, [row['id'] for row in commits[0]])
+
+    def test_idempotency_keys_return_the_original_message(self):
+        commits = []
+        self.database.add_listener(commits.append)
+        first_id = self.database.add_message("Hello", "repo1", idempotency_key="key-1")
+        self.assertEqual(self.database.add_message("Hello", "repo1", idempotency_key="key-1"), first_id)
+
+        rows = self.database.add_messages([
+            ("Retried", "repo1", "key-1"),
+            ("New", "repo1", None),
+            ("New with key", "repo1", "key-2"),
+            ("Same key in batch", "repo1", "key-2")
+        ])
+        self.assertEqual(rows[0]['id'], first_id)
+        self.assertEqual(rows[0]['content'], "Hello")
+        self.assertEqual(rows[3], rows[2])
+        self.assertEqual([msg['content'] for msg in self.database.get_messages()], ["Hello", "New", "New with key"])
+        # Retries are neither written, announced nor synced again
+        self.assertEqual(len(commits), 2)
+        self.assertEqual(len(commits[1]), 2)
+        self.assertEqual(self.database.count_pending_sync(), 3)
+
+        # Nothing to write at all
+        self.assertEqual(self.database.add_messages([("New with key", "repo1", "key-2")]), [rows[2]])
+        self.assertEqual(len(commits), 2)
+
+    def test_group_commit_writer_isolates_bad_messages(self):
+        writer = chat_server.GroupCommitWriter(self.database, window=0.2)
+        futures = [writer.submit("good 1", "repo1"), writer.submit({"x": 1}, "repo1"),
+                   writer.submit("good 2", "repo1")]
+        writer.start()
+        try:
+            self.assertIsInstance(futures[0].result(5), int)
+            with self.assertRaises(Exception):
+                futures[1].result(5)
+            self.assertIsInstance(futures[2].result(5), int)
+        finally:
+            writer.stop(timeout=5)
+        self.assertEqual([msg['content'] for msg in self.database.get_messages()], ["good 1", "good 2"])
+
+    def test_group_commit_writer_suppresses_duplicate_keys(self):
+        writer = chat_server.GroupCommitWriter(self.database, window=0.2)
+        futures = [writer.submit("Retried", "repo1", "key-1") for _ in range(3)]
+        writer.start()
+        try:
+            ids = {future.result(5) for future in futures}
+            self.assertEqual(ids, {writer.submit("Retried", "repo1", "key-1").result(5)})
+        finally:
+            writer.stop(timeout=5)
+        self.assertEqual(len(self.database.get_messages()), 1)
+
+    def test_full_text_search(self):
+        self.database.add_message("Deploying the GitHub integration", "repo1")
+        self.database.add_message("Lunch plans", "repo1")
+        self.database.add_message("GitHub push failed again", "repo2")
+
+        results = self.database.search_messages(chat_server._fts_query("github"))
+        self.assertEqual(len(results), 2)
+        self.assertIn('[GitHub]', results[0]['snippet'])
+
+        results = self.database.search_messages(chat_server._fts_query("github"), repository="repo2")
+        self.assertEqual([msg['content'] for msg in results], ["GitHub push failed again"])
+
+        # Quoting keeps FTS5 operators in user input from being interpreted
+        self.assertEqual(self.database.search_messages(chat_server._fts_query('push" OR lunch')), [])
+
+    def test_migration_backfills_existing_database(self):
+        # A database created before the full-text index existed
+        legacy_db = tempfile.mktemp()
+        conn = sqlite3.connect(legacy_db)
+        conn.execute('''
+            CREATE TABLE messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                repository TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO messages (content, repository) VALUES ('legacy history', 'repo1')")
+        conn.commit()
+        conn.close()
+
+        database = chat_server.Database(legacy_db)
+        try:
+            self.assertEqual(database.conn.execute('PRAGMA user_version').fetchone()[0],
+                             len(chat_server.MIGRATIONS))
+            results = database.search_messages(chat_server._fts_query("legacy"))
+            self.assertEqual([msg['content'] for msg in results], ["legacy history"])
+        finally:
+            database.close()
+            os.unlink(legacy_db)
+
+    def test_connections_are_per_thread_and_reused(self):
+        self.assertIs(self.database.conn, self.database.conn)
+        mode = self.database.conn.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+        # Another thread gets its own connection but sees the same data
+        self.database.add_message("Shared message", "repo1")
+        seen = {}
+        def read_from_thread():
+            seen['conn'] = self.database.conn
+            seen['messages'] = self.database.get_messages()
+        thread = threading.Thread(target=read_from_thread)
+        thread.start()
+        thread.join()
+        self.assertIsNot(seen['conn'], self.database.conn)
+        self.assertEqual(seen['messages'][0]['content'], "Shared message")
+
+    def test_get_database_is_process_wide(self):
+        self.assertIs(chat_server.get_database(self.temp_db), chat_server.get_database(self.temp_db))
+        chat_server.get_database(self.temp_db).close()
+        del chat_server._databases[self.temp_db]
+
 class TestRepositoryManager(unittest.TestCase):
     def setUp(self):
         # Create a temporary database for testing
@@ -55,13 +290,13 @@ class TestRepositoryManager(unittest.TestCase):
         self.database = chat_server.Database(self.temp_db)
 
     def tearDown(self):
-        # Close the database connection and remove the temporary file
-        self.database.conn.close()
+        # Close the database connections and remove the temporary file
+        self.database.close()
         if os.path.exists(self.temp_db):
             os.unlink(self.temp_db)
 
-    @patch('requests.put')
-    @patch('requests.get')
+    @patch('requests.Session.put')
+    @patch('requests.Session.get')
     def test_push_messages(self, mock_get, mock_put):
         # Setup mock responses that simulate successful GitHub interaction
         mock_get.return_value = MagicMock(
@@ -92,10 +327,563 @@ class TestRepositoryManager(unittest.TestCase):
         # Assert that the push was successful
         self.assertTrue(result, "Messages should be successfully pushed to GitHub")
 
-        # Verify that GitHub API methods were called
-        mock_get.assert_called_once()
+        # A new file is created with a single PUT; no GET is needed
+        mock_get.assert_not_called()
         mock_put.assert_called_once()
 
+    @patch('requests.Session.put')
+    def test_push_records_metrics_without_logging_payloads(self, mock_put):
+        mock_put.return_value = MagicMock(status_code=201, text='RESPONSE BODY', headers={})
+        self.database.add_message("Secret message content", "test_repo")
+        repo_manager = chat_server.RepositoryManager('mock_token', 'mock_username', 'mock_repo')
+        responses = chat_server.GITHUB_RESPONSES.value('put', '201')
+        pushed_bytes = chat_server.GITHUB_BYTES_PUSHED.value()
+        latencies = chat_server.GITHUB_REQUEST_SECONDS.count('put')
+
+        with self.assertLogs('chat_server', level='DEBUG') as logs:
+            self.assertTrue(repo_manager.push_messages(self.database.get_messages()))
+
+        self.assertEqual(chat_server.GITHUB_RESPONSES.value('put', '201'), responses + 1)
+        self.assertEqual(chat_server.GITHUB_REQUEST_SECONDS.count('put'), latencies + 1)
+        sent = len(mock_put.call_args.kwargs['data'])
+        self.assertEqual(chat_server.GITHUB_BYTES_PUSHED.value(), pushed_bytes + sent)
+        output = '\n'.join(logs.output)
+        self.assertNotIn('RESPONSE BODY', output)
+        self.assertNotIn('Secret message content', output)
+        self.assertNotIn('mock_token', output)
+
+class TestSyncWorker(unittest.TestCase):
+    def setUp(self):
+        self.temp_db = tempfile.mktemp()
+        self.database = chat_server.Database(self.temp_db)
+        self.repo_manager = chat_server.RepositoryManager('mock_token', 'mock_username', 'mock_repo')
+        self.repo_manager.push_messages = MagicMock()
+
+    def tearDown(self):
+        self.database.close()
+        if os.path.exists(self.temp_db):
+            os.unlink(self.temp_db)
+
+    def test_sync_marks_outbox_entries(self):
+        message_id = self.database.add_message("Queued message", "test_repo")
+        self.assertEqual(self.database.get_sync_status(message_id)['status'], 'pending')
+
+        # A failed push keeps the entry pending and records the error
+        self.repo_manager.push_messages.return_value = False
+        worker = chat_server.SyncWorker(self.repo_manager, self.database)
+        self.assertFalse(worker.sync())
+        status = self.database.get_sync_status(message_id)
+        self.assertEqual(status['status'], 'pending')
+        self.assertEqual(status['attempts'], 1)
+        self.assertIsNotNone(status['last_error'])
+
+        self.repo_manager.push_messages.return_value = True
+        self.assertTrue(worker.sync())
+        self.assertEqual(self.database.get_sync_status(message_id)['status'], 'synced')
+        self.assertEqual(self.database.get_pending_sync(), [])
+
+    def test_messages_during_push_are_coalesced(self):
+        first_push_started = threading.Event()
+        release_first_push = threading.Event()
+        pushed = []
+
+        def push_messages(messages):
+            pushed.append([msg['content'] for msg in messages])
+            if len(pushed) == 1:
+                first_push_started.set()
+                release_first_push.wait(5)
+            return True
+
+        self.repo_manager.push_messages.side_effect = push_messages
+        worker = chat_server.SyncWorker(self.repo_manager, self.database, chat_server.PushScheduler(debounce=0))
+        self.database.add_message("First", "test_repo")
+        worker.start()
+        try:
+            self.assertTrue(first_push_started.wait(5))
+            # Both of these arrive while the first push is in flight
+            for content in ("Second", "Third"):
+                self.database.add_message(content, "test_repo")
+                worker.notify()
+            release_first_push.set()
+
+            for _ in range(100):
+                if not self.database.get_pending_sync():
+                    break
+                time.sleep(0.05)
+        finally:
+            worker.stop(timeout=5)
+
+        self.assertEqual(pushed, [["First"], ["First", "Second", "Third"]])
+
+    def test_sync_loads_only_touched_shards(self):
+        old_id = self.database.add_message("Old day", "test_repo")
+        self.database.conn.execute("UPDATE messages SET timestamp = '2024-12-31 10:00:00' WHERE id = ?", (old_id,))
+        self.database.conn.commit()
+        worker = chat_server.SyncWorker(self.repo_manager, self.database)
+        self.repo_manager.push_messages.return_value = True
+        self.assertTrue(worker.sync())
+
+        self.database.add_message("Today", "test_repo")
+        self.assertTrue(worker.sync())
+        pushed = self.repo_manager.push_messages.call_args[0][0]
+        self.assertEqual([msg['content'] for msg in pushed], ["Today"])
+
+class TestRepositoryFanOut(unittest.TestCase):
+    def setUp(self):
+        self.temp_db = tempfile.mktemp()
+        self.database = chat_server.Database(self.temp_db)
+        self.registry = chat_server.RepositoryRegistry()
+        self.managers = {}
+        for name in ('main', 'slow'):
+            manager = chat_server.RepositoryManager('mock_token', 'mock_username', name)
+            manager.push_messages = MagicMock(return_value=True)
+            self.managers[name] = manager
+            self.registry.add(name, manager, chat_server.PushScheduler(debounce=0), default=name == 'main')
+
+    def tearDown(self):
+        self.database.close()
+        if os.path.exists(self.temp_db):
+            os.unlink(self.temp_db)
+
+    def test_messages_are_routed_by_repository(self):
+        self.assertIs(self.registry.resolve('slow').repo_manager, self.managers['slow'])
+        self.assertIs(self.registry.resolve('unknown').repo_manager, self.managers['main'])
+
+        self.database.add_message("For main", "main")
+        self.database.add_message("For slow", "slow")
+        self.database.add_message("Unrouted", "default")
+        worker = chat_server.SyncWorker(self.registry, self.database)
+        self.assertTrue(worker.sync())
+        worker.stop()
+
+        main_messages = self.managers['main'].push_messages.call_args[0][0]
+        slow_messages = self.managers['slow'].push_messages.call_args[0][0]
+        self.assertEqual([msg['content'] for msg in main_messages], ["For main", "Unrouted"])
+        self.assertEqual([msg['content'] for msg in slow_messages], ["For slow"])
+        self.assertEqual(self.database.get_pending_sync(), [])
+
+    def test_forced_push_skips_idle_targets(self):
+        self.database.add_message("For main", "main")
+        worker = chat_server.SyncWorker(self.registry, self.database)
+        self.addCleanup(worker.stop)
+        self.assertTrue(worker.sync(force=True))
+        self.managers['slow'].push_messages.assert_not_called()
+        # The idle repository is not put into backoff
+        self.assertEqual(self.registry.targets['slow'].scheduler.failures, 0)
+
+    def test_slow_target_does_not_block_others(self):
+        release = threading.Event()
+        main_pushed = threading.Event()
+        self.managers['slow'].push_messages.side_effect = lambda messages: release.wait(5)
+        self.managers['main'].push_messages.side_effect = lambda messages: main_pushed.set() or True
+
+        worker = chat_server.SyncWorker(self.registry, self.database)
+        slow_id = self.database.add_message("For slow", "slow")
+        worker.start()
+        try:
+            for _ in range(100):
+                if self.registry.targets['slow'].in_flight:
+                    break
+                time.sleep(0.01)
+            main_id = self.database.add_message("For main", "main")
+            worker.notify()
+            # main is pushed while slow is still stuck
+            self.assertTrue(main_pushed.wait(5))
+            for _ in range(100):
+                if self.database.get_sync_status(main_id)['status'] == 'synced':
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.database.get_sync_status(main_id)['status'], 'synced')
+            self.assertEqual(self.database.get_sync_status(slow_id)['status'], 'pending')
+        finally:
+            release.set()
+            worker.stop(timeout=5)
+
+class TestPushScheduling(unittest.TestCase):
+    def test_rate_limit_headers(self):
+        rate_limit = chat_server.RateLimitState()
+        rate_limit.update(200, {
+            'X-RateLimit-Limit': '5000',
+            'X-RateLimit-Remaining': '10',
+            'X-RateLimit-Reset': '1100'
+        }, now=1000)
+        self.assertEqual(rate_limit.wait_time(now=1000), 0)
+        # Ten requests left for 100 seconds: one every ten seconds
+        self.assertEqual(rate_limit.pacing_interval(now=1000), 10)
+
+        rate_limit.update(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1100'}, now=1000)
+        self.assertEqual(rate_limit.wait_time(now=1000), 100)
+
+        # Secondary limits are signalled with Retry-After
+        rate_limit = chat_server.RateLimitState()
+        rate_limit.update(429, {'Retry-After': '30'}, now=1000)
+        self.assertEqual(rate_limit.wait_time(now=1010), 20)
+        self.assertEqual(rate_limit.snapshot()['blocked_until'], 1030)
+
+    def test_backoff_grows_with_jitter(self):
+        scheduler = chat_server.PushScheduler(debounce=0, backoff_base=2, backoff_max=10)
+        rate_limit = chat_server.RateLimitState()
+        delays = []
+        for _ in range(5):
+            scheduler.record_failure(now=0)
+            delays.append(scheduler.next_delay(rate_limit, now=0))
+        for delay, cap in zip(delays, [2, 4, 8, 10, 10]):
+            self.assertGreaterEqual(delay, cap / 2)
+            self.assertLessEqual(delay, cap)
+        scheduler.record_success(now=0)
+        self.assertEqual(scheduler.next_delay(rate_limit, now=0), 0)
+
+    @patch('requests.Session.put')
+    def test_push_stops_when_rate_limited(self, mock_put):
+        mock_put.return_value = Mock(status_code=403, text='rate limited',
+                                     headers={'Retry-After': '60'})
+        repo_manager = chat_server.RepositoryManager('mock_token', 'mock_username', 'mock_repo')
+        messages = [
+            {'id': 1, 'content': 'Day one', 'timestamp': '2025-01-08 19:55:00'},
+            {'id': 2, 'content': 'Day two', 'timestamp': '2025-01-09 08:00:00'}
+        ]
+        self.assertFalse(repo_manager.push_messages(messages))
+        # The second shard is not attempted until the limit clears
+        mock_put.assert_called_once()
+        self.assertGreater(repo_manager.rate_limit.wait_time(), 0)
+
+class TestShardedPush(unittest.TestCase):
+    def setUp(self):
+        self.repo_manager = chat_server.RepositoryManager('mock_token', 'mock_username', 'mock_repo')
+        self.repo_manager._push_file = MagicMock(return_value=True)
+        self.messages = [
+            {'id': 1, 'content': 'Day one', 'timestamp': '2025-01-08 19:55:00'},
+            {'id': 2, 'content': 'Day two', 'timestamp': '2025-01-09 08:00:00'}
+        ]
+
+    def test_only_changed_shards_are_pushed(self):
+        self.assertTrue(self.repo_manager.push_messages(self.messages))
+        pushed = [call[0][0] for call in self.repo_manager._push_file.call_args_list]
+        self.assertEqual(pushed, ['chat_messages/2025-01-08.md', 'chat_messages/2025-01-09.md'])
+
+        # Nothing changed, so nothing is uploaded
+        self.repo_manager._push_file.reset_mock()
+        self.assertTrue(self.repo_manager.push_messages(self.messages))
+        self.repo_manager._push_file.assert_not_called()
+
+        self.messages.append({'id': 3, 'content': 'Day two again', 'timestamp': '2025-01-09 09:00:00'})
+        self.assertTrue(self.repo_manager.push_messages(self.messages))
+        self.repo_manager._push_file.assert_called_once()
+        file_path, content, count = self.repo_manager._push_file.call_args[0]
+        self.assertEqual(file_path, 'chat_messages/2025-01-09.md')
+        self.assertEqual(content, "# Chat Messages\n\n## 2025-01-09 08:00:00\nDay two\n\n"
+                                  "## 2025-01-09 09:00:00\nDay two again\n\n")
+        self.assertEqual(count, 2)
+
+    def test_failed_shard_is_retried(self):
+        self.repo_manager._push_file.side_effect = lambda path, content, count: path.endswith('08.md')
+        self.assertFalse(self.repo_manager.push_messages(self.messages))
+        self.repo_manager._push_file.reset_mock(side_effect=True)
+        self.repo_manager._push_file.return_value = True
+        self.assertTrue(self.repo_manager.push_messages(self.messages))
+        self.assertEqual(self.repo_manager._push_file.call_args[0][0], 'chat_messages/2025-01-09.md')
+        self.repo_manager._push_file.assert_called_once()
+
+    def test_count_shards(self):
+        repo_manager = chat_server.RepositoryManager('t', 'u', 'r', shard_by='count', shard_size=100)
+        self.assertEqual(repo_manager.shard_path({'id': 250}), 'chat_messages/00000200-00000299.md')
+        self.assertEqual(repo_manager.shard_range({'id': 250}), ('id', 200, 300))
+
+@unittest.skipIf(shutil.which('git') is None, 'git is not installed')
+class TestGitMirrorBackend(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.remote = os.path.join(self.temp_dir, 'remote.git')
+        subprocess.run(['git', 'init', '--quiet', '--bare', self.remote], check=True)
+        self.mirror = os.path.join(self.temp_dir, 'mirror.git')
+        self.backend = chat_server.GitMirrorBackend(self.mirror, 'general', remotes=['file://' + self.remote])
+        self.messages = [
+            {'id': 1, 'timestamp': '2025-01-08 10:00:00', 'content': 'First'},
+            {'id': 2, 'timestamp': '2025-01-08 11:00:00', 'content': 'Second'},
+            {'id': 3, 'timestamp': '2025-01-09 09:00:00', 'content': 'Next day'}
+        ]
+
+    def _git(self, git_dir, *args):
+        return subprocess.run(['git', '--git-dir', git_dir, *args],
+                              capture_output=True, text=True, check=True).stdout
+
+    def test_batch_is_one_commit(self):
+        self.assertTrue(self.backend.push_messages(self.messages))
+        self.assertEqual(self._git(self.mirror, 'rev-list', '--count', 'master').strip(), '1')
+        self.assertEqual(self._git(self.mirror, 'show', 'master:chat_messages/2025-01-08.md'),
+                         self.backend.render_shard(self.messages[:2]))
+
+        # Unchanged shards are not committed again, even from a new process
+        backend = chat_server.GitMirrorBackend(self.mirror, 'general')
+        self.assertTrue(backend.push_messages(self.messages[2:]))
+        self.assertEqual(self._git(self.mirror, 'rev-list', '--count', 'master').strip(), '1')
+
+        self.messages.append({'id': 4, 'timestamp': '2025-01-09 10:00:00', 'content': 'Later'})
+        self.assertTrue(backend.push_messages(self.messages[2:]))
+        self.assertEqual(self._git(self.mirror, 'rev-list', '--count', 'master').strip(), '2')
+        self.assertEqual(self._git(self.mirror, 'diff', '--name-only', 'master~1', 'master'),
+                         'chat_messages/2025-01-09.md\n')
+
+    def test_pushes_on_stop_and_restores(self):
+        self.backend.start()
+        self.assertTrue(self.backend.push_messages(self.messages))
+        # The scheduled push has not come round yet; stopping pushes what is left
+        self.backend.stop(timeout=10)
+        self.assertEqual(self._git(self.remote, 'rev-parse', 'master').strip(), self.backend.head)
+
+        temp_db = os.path.join(self.temp_dir, 'messages.db')
+        database = chat_server.Database(temp_db)
+        self.addCleanup(database.close)
+        registry = chat_server.RepositoryRegistry()
+        registry.add('general', chat_server.GitMirrorBackend(self.remote, 'general'))
+        self.assertEqual(chat_server.restore_history(database, registry), 3)
+        self.assertEqual([msg['content'] for msg in database.get_messages()], ['First', 'Second', 'Next day'])
+
+    def test_new_mirror_builds_on_remote_history(self):
+        self.backend.push_messages(self.messages[:2])
+        self.assertTrue(self.backend.push_remotes())
+        # A mirror created on a new node starts from the remote's history
+        fresh = chat_server.GitMirrorBackend(os.path.join(self.temp_dir, 'fresh.git'), 'general',
+                                             remotes=['file://' + self.remote])
+        self.assertEqual(fresh.history_files(), ['chat_messages/2025-01-08.md'])
+        self.assertEqual(list(fresh.iter_file_lines('chat_messages/2025-01-08.md'))[3], 'First\n')
+        fresh.push_messages(self.messages[2:])
+        self.assertTrue(fresh.push_remotes())
+        self.assertEqual(self._git(self.remote, 'rev-parse', 'master').strip(), fresh.head)
+        self.assertEqual(self._git(self.remote, 'rev-list', '--count', 'master').strip(), '2')
+
+    def test_rejected_push_is_retried(self):
+        self.backend.push_messages(self.messages[:1])
+        self.assertTrue(self.backend.push_remotes())
+        first = self.backend.head
+        # Someone else moved the remote branch
+        other = chat_server.GitMirrorBackend(os.path.join(self.temp_dir, 'other.git'), 'general',
+                                             remotes=['file://' + self.remote])
+        other.push_messages(self.messages[2:])
+        self.assertTrue(other.push_remotes())
+
+        # Our next push is rejected; the remote tip is merged in and pushed
+        self.backend.push_messages(self.messages[:2])
+        self.assertTrue(self.backend.push_remotes())
+        self.assertEqual(self._git(self.remote, 'rev-parse', 'master').strip(), self.backend.head)
+        self.assertEqual(self._git(self.remote, 'ls-tree', '--name-only', '-r', 'master').split(),
+                         ['chat_messages/2025-01-08.md', 'chat_messages/2025-01-09.md'])
+        self.assertEqual(self._git(self.remote, 'show', 'master:chat_messages/2025-01-08.md'),
+                         self.backend.render_shard(self.messages[:2]))
+        # Commits made before the merge are still part of what was pushed
+        self.assertTrue(self.backend.includes(self.backend.head, first))
+        self.assertTrue(self.backend.includes(self.backend.head, other.head))
+        self.assertEqual(self.backend.history_files(), ['chat_messages/2025-01-08.md', 'chat_messages/2025-01-09.md'])
+
+    def test_synced_once_pushed_to_remotes(self):
+        database = chat_server.Database(os.path.join(self.temp_dir, 'messages.db'))
+        self.addCleanup(database.close)
+        missing = os.path.join(self.temp_dir, 'missing.git')
+        backend = chat_server.GitMirrorBackend(self.mirror, 'general', remotes=['file://' + missing])
+        worker = chat_server.SyncWorker(backend, database)
+        self.addCleanup(worker.stop)
+        message_id = database.add_message('First', 'general')
+
+        self.assertTrue(worker.sync())
+        self.assertEqual(database.get_sync_status(message_id)['status'], 'committed')
+        self.assertEqual(worker.status()['committed'], 1)
+        # The remote is not there yet; the message stays committed
+        with self.assertLogs('chat_server', 'ERROR'):
+            self.assertFalse(backend.push_remotes())
+        self.assertEqual(database.get_sync_status(message_id)['status'], 'committed')
+
+        # A later commit on top of it is pushed; both messages reach the remote
+        second_id = database.add_message('Second', 'general')
+        self.assertTrue(worker.sync())
+        subprocess.run(['git', 'init', '--quiet', '--bare', missing], check=True)
+        self.assertTrue(backend.push_remotes())
+        self.assertEqual(database.get_sync_status(message_id)['status'], 'synced')
+        self.assertEqual(database.get_sync_status(second_id)['status'], 'synced')
+        self.assertEqual(worker.status()['committed'], 0)
+
+        # Without remotes the mirror is the destination
+        local = chat_server.SyncWorker(chat_server.GitMirrorBackend(self.mirror, 'general'), database)
+        self.addCleanup(local.stop)
+        third_id = database.add_message('Third', 'general')
+        self.assertTrue(local.sync())
+        self.assertEqual(database.get_sync_status(third_id)['status'], 'synced')
+
+    def test_backend_must_implement_interface(self):
+        class PushOnly(chat_server.SyncBackend):
+            def _push_messages(self, messages):
+                return True
+
+        with self.assertRaises(TypeError):
+            PushOnly('general')
+
+    @patch.dict(os.environ, {'SYNC_BACKEND': 'git', 'GIT_REMOTES': 'git@example.com:{owner}/{repository}.git',
+                             'REPOSITORIES': 'general=acme/chat', 'REPOSITORY_NAME': 'general'})
+    def test_registry_from_env(self):
+        with patch.dict(os.environ, {'GIT_MIRROR_DIR': self.temp_dir}):
+            backend = chat_server.RepositoryRegistry.from_env().resolve('general').repo_manager
+        self.assertIsInstance(backend, chat_server.GitMirrorBackend)
+        self.assertEqual(backend.mirror_path, os.path.join(self.temp_dir, 'acme', 'chat.git'))
+        self.assertEqual(backend.remotes, ['git@example.com:acme/chat.git'])
+        # The mirror is only created once something is synced
+        self.assertFalse(os.path.exists(backend.mirror_path))
+
+class TestRestore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.database = chat_server.Database(os.path.join(self.temp_dir, 'messages.db'))
+        self.repo_manager = chat_server.RepositoryManager('mock_token', 'mock_username', 'mock_repo')
+        self.history = [
+            {'timestamp': '2025-01-08 19:55:00', 'content': 'Line one\nLine two'},
+            {'timestamp': '2025-01-08 19:56:00', 'content': 'Twice'},
+            {'timestamp': '2025-01-08 19:56:00', 'content': 'Twice'},
+            {'timestamp': '2025-01-08 19:57:00', 'content': 'Ends with newline\n'}
+        ]
+
+    def tearDown(self):
+        self.database.close()
+
+    def test_parse_round_trips_rendered_shards(self):
+        text = self.repo_manager.render_shard(self.history)
+        sections = list(chat_server.parse_chat_markdown(io.StringIO(text)))
+        self.assertEqual(sections, [(msg['timestamp'], msg['content']) for msg in self.history])
+        # Lines may also arrive without terminators, split anywhere in between
+        chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+        self.assertEqual(list(chat_server.parse_chat_markdown(chat_server._split_lines(chunks))), sections)
+
+    def test_restore_skips_existing_messages(self):
+        self.database.add_message('Twice', 'general')
+        self.database.conn.execute("UPDATE messages SET timestamp = '2025-01-08 19:56:00'")
+        self.database.conn.commit()
+        sections = [(msg['timestamp'], msg['content']) for msg in self.history]
+        version = self.database.version
+
+        # The same history listed twice, as in the legacy file and a shard
+        restored = self.database.restore_messages([('general', sections), ('general', sections[1:])])
+        self.assertEqual(restored, 3)
+        self.assertGreater(self.database.version, version)
+        messages = self.database.get_messages()
+        self.assertEqual(sorted(msg['content'] for msg in messages),
+                         sorted(msg['content'] for msg in self.history))
+        # Only the message written locally waits for sync
+        self.assertEqual(self.database.count_pending_sync(), 1)
+
+        self.assertEqual(self.database.restore_messages([('general', sections)]), 0)
+
+    def test_restore_skips_archived_messages(self):
+        sections = [(msg['timestamp'], msg['content']) for msg in self.history]
+        self.assertTrue(self.database.is_empty())
+        self.assertEqual(self.database.restore_messages([('general', sections)]), 4)
+        self.assertEqual(self.database.archive_messages(4, '2025-01-08 19:56:30'), 3)
+        self.assertFalse(self.database.is_empty())
+
+        # Every message is in the hot table or the archive already
+        self.assertEqual(self.database.restore_messages([('general', sections)]), 0)
+        self.assertEqual(self.database.get_latest_id(), 4)
+        self.assertEqual(self.database.archive_messages(5, '2025-01-09 00:00:00'), 1)
+        self.assertFalse(self.database.is_empty())
+        self.assertEqual(self.database.restore_messages([('general', sections)]), 0)
+
+    @patch('requests.Session.get')
+    def test_restore_from_repository(self, mock_get):
+        text = self.repo_manager.render_shard(self.history)
+        tree = {'truncated': False, 'tree': [
+            {'path': 'README.md', 'type': 'blob', 'sha': 'a'},
+            {'path': 'chat_messages', 'type': 'tree', 'sha': 'b'},
+            {'path': 'chat_messages/2025-01-08.md', 'type': 'blob', 'sha': 'c'}
+        ]}
+
+        def get(url, **kwargs):
+            if '/git/trees/' in url:
+                return MagicMock(status_code=200, json=lambda: tree, headers={})
+            self.assertTrue(url.endswith('/contents/chat_messages/2025-01-08.md'))
+            self.assertTrue(kwargs['stream'])
+            response = MagicMock(status_code=200, headers={})
+            response.__enter__.return_value = response
+            response.iter_content.return_value = [text[:30], text[30:]]
+            return response
+        mock_get.side_effect = get
+
+        registry = chat_server.RepositoryRegistry()
+        registry.add('general', self.repo_manager)
+        self.assertEqual(chat_server.restore_history(self.database, registry), 4)
+        self.assertEqual([msg['repository'] for msg in self.database.get_messages()], ['general'] * 4)
+        # The next push updates the shard without looking up its SHA
+        self.assertEqual(self.repo_manager.file_shas, {'chat_messages/2025-01-08.md': 'c'})
+
+    def test_restore_command_from_file(self):
+        path = os.path.join(self.temp_dir, 'chat_messages.md')
+        with open(path, 'w') as f:
+            f.write(self.repo_manager.render_shard(self.history))
+        db_path = os.path.join(self.temp_dir, 'restored.db')
+
+        with patch.object(chat_server.MessageHandler, 'db_path'):
+            chat_server.main(['restore', '--db', db_path, '--from-file', path, '--repository', 'general'])
+
+        restored = chat_server.Database(db_path)
+        self.addCleanup(restored.close)
+        self.assertEqual([msg['content'] for msg in restored.get_messages()],
+                         [msg['content'] for msg in self.history])
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.temp_db = tempfile.mktemp()
+        self.database = chat_server.Database(self.temp_db)
+        # Ten synced messages a day apart, oldest first
+        for day in range(10):
+            message_id = self.database.add_message(f"Day {day}", "test_repo")
+            self.database.conn.execute(
+                'UPDATE messages SET timestamp = ? WHERE id = ?',
+                (f'2025-01-{day + 1:02d} 12:00:00', message_id)
+            )
+        self.database.conn.commit()
+        self.database.mark_synced(range(1, 11))
+        self.now = datetime(2025, 1, 11, 9, 0, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        self.database.close()
+        if os.path.exists(self.temp_db):
+            os.unlink(self.temp_db)
+
+    def test_archives_old_messages_in_batches(self):
+        retention = chat_server.RetentionWorker(self.database, max_age_days=5, batch_size=2)
+        before_id, cutoff = retention.bounds(self.now)
+        self.assertEqual(cutoff, '2025-01-06')
+        version = self.database.version
+
+        with patch.object(retention, 'bounds', return_value=(before_id, cutoff)):
+            self.assertEqual(retention.run_pass(), 5)
+        self.assertGreater(self.database.version, version)
+        self.assertEqual([msg['id'] for msg in self.database.get_messages()], [6, 7, 8, 9, 10])
+        self.assertEqual(len(self.database.search_messages('Day')), 5)
+        self.assertEqual(
+            self.database.conn.execute('SELECT COUNT(*) FROM messages_archive').fetchone()[0], 3
+        )
+        self.assertIsNone(self.database.get_sync_status(1))
+
+        # The archive pages like GET /messages
+        self.assertEqual([msg['id'] for msg in self.database.get_archived_messages(limit=3)], [3, 4, 5])
+        self.assertEqual([msg['id'] for msg in self.database.get_archived_messages(before_id=3, limit=3)], [1, 2])
+        self.assertEqual([msg['id'] for msg in self.database.get_archived_messages(since_id=1, limit=3)], [2, 3, 4])
+        self.assertEqual(self.database.get_archived_messages(since_id=1, limit=1)[0]['content'], "Day 1")
+        self.assertTrue(self.database.has_archived_messages_before(3))
+        self.assertFalse(self.database.has_archived_messages_before(1))
+
+    def test_pending_messages_hold_back_their_day(self):
+        self.database.conn.execute("UPDATE sync_outbox SET status = 'pending' WHERE message_id = 3")
+        self.database.conn.commit()
+        retention = chat_server.RetentionWorker(self.database, max_age_days=5)
+        self.assertEqual(retention.bounds(self.now), (3, '2025-01-03'))
+
+    def test_count_shards_are_archived_whole(self):
+        registry = chat_server.RepositoryRegistry()
+        registry.add('test_repo', chat_server.RepositoryManager('t', 'u', 'r', shard_by='count', shard_size=4))
+        retention = chat_server.RetentionWorker(self.database, max_age_days=5, registry=registry)
+        # Ids 1-5 are old enough, but 4 and 5 share a shard with newer rows
+        self.assertEqual(retention.bounds(self.now), (4, '2025-01-06'))
+        # With every message old, the shard still being filled stays hot
+        self.assertEqual(retention.bounds(datetime(2026, 1, 1, tzinfo=timezone.utc)), (8, '2025-12-27'))
+
 class TestMessageHandler(unittest.TestCase):
     def setUp(self):
         # Create a mock server for testing HTTP handlers
@@ -129,6 +917,7 @@ class TestMessageHandler(unittest.TestCase):
         # Simulate a GET request to /messages
         handler = self.handler(MockSocket(), self.server_address, None)
         handler.path = '/messages'
+        handler.headers = {}
         handler.wfile = MagicMock()  # Mock the wfile attribute
         handler.send_response = MagicMock()
         handler.send_header = MagicMock()
@@ -145,6 +934,750 @@ class TestMessageHandler(unittest.TestCase):
         self.assertEqual(len(retrieved_messages), 1)
         self.assertEqual(retrieved_messages[0]['content'], 'Test message')
 
+class TestBroadcastHub(unittest.TestCase):
+    def test_ring_serves_recent_messages(self):
+        hub = chat_server.BroadcastHub(latest_id=10, capacity=2)
+        self.assertEqual(hub.messages_after(10, 100), [])
+        hub.publish([{'id': 11}, {'id': 12}])
+        self.assertEqual(hub.messages_after(10, 100), [{'id': 11}, {'id': 12}])
+
+        # Once 11 is evicted, cursors before it must go to the database
+        hub.publish([{'id': 13}])
+        self.assertIsNone(hub.messages_after(10, 100))
+        self.assertEqual(hub.messages_after(11, 100), [{'id': 12}, {'id': 13}])
+
+    def test_wait_for_wakes_on_publish(self):
+        hub = chat_server.BroadcastHub(latest_id=1)
+        self.assertFalse(hub.wait_for(1, 0.01))
+        threading.Timer(0.05, hub.publish, args=([{'id': 2}],)).start()
+        self.assertTrue(hub.wait_for(1, 5))
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = chat_server.Histogram('test_seconds', 'Test.', ('route',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, '/a')
+        histogram.observe(0.5, '/a')
+        histogram.observe(5, '/a')
+
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{route="/a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="/a",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{route="/a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{route="/a"} 5.55', lines)
+        self.assertIn('test_seconds_count{route="/a"} 3', lines)
+
+    def test_counter_escapes_label_values(self):
+        counter = chat_server.Counter('test_total', 'Test.', ('path',))
+        counter.inc('a"b')
+        counter.inc('a"b', amount=2)
+        self.assertIn('test_total{path="a\\"b"} 3', counter.render())
+
+    def test_database_calls_are_timed(self):
+        temp_db = tempfile.mktemp()
+        database = chat_server.Database(temp_db)
+        self.addCleanup(os.unlink, temp_db)
+        self.addCleanup(database.close)
+        before = chat_server.SQLITE_QUERY_SECONDS.count('add_message')
+        database.add_message("Timed", "test_repo")
+        self.assertEqual(chat_server.SQLITE_QUERY_SECONDS.count('add_message'), before + 1)
+
+class TestServerModes(unittest.TestCase):
+    def setUp(self):
+        self.temp_db = tempfile.mktemp()
+        self.database = chat_server.get_database(self.temp_db)
+        self.database.add_message("Existing message", "test_repo")
+        db_path_patch = patch.object(chat_server.MessageHandler, 'db_path', self.temp_db)
+        db_path_patch.start()
+        self.addCleanup(db_path_patch.stop)
+
+    def tearDown(self):
+        self.database.close()
+        del chat_server._databases[self.temp_db]
+        if os.path.exists(self.temp_db):
+            os.unlink(self.temp_db)
+
+    def _start(self, mode):
+        httpd = chat_server.create_server(0, mode, workers=4)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        if mode == 'asyncio':
+            self.assertTrue(httpd.ready.wait(5))
+        def stop():
+            httpd.shutdown()
+            thread.join(5)
+            httpd.server_close()
+        self.addCleanup(stop)
+        return httpd.server_address[1]
+
+    def _assert_keep_alive(self, port):
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        try:
+            for _ in range(3):
+                conn.request('GET', '/messages')
+                response = conn.getresponse()
+                self.assertEqual(response.status, 200)
+                self.assertEqual(json.loads(response.read())[0]['content'], "Existing message")
+            # The same socket served every request
+            self.assertFalse(response.will_close)
+        finally:
+            conn.close()
+
+    def _assert_slow_request_does_not_block(self, port):
+        release = threading.Event()
+        original = chat_server.Database.get_sync_status
+
+        def slow_status(database, message_id):
+            release.wait(5)
+            return original(database, message_id)
+
+        with patch.object(chat_server.Database, 'get_sync_status', slow_status):
+            slow = http.client.HTTPConnection('localhost', port, timeout=5)
+            slow.request('GET', '/messages/1/sync')
+            try:
+                fast = http.client.HTTPConnection('localhost', port, timeout=5)
+                fast.request('GET', '/messages')
+                self.assertEqual(fast.getresponse().status, 200)
+                fast.close()
+            finally:
+                release.set()
+            self.assertEqual(slow.getresponse().status, 200)
+            slow.close()
+
+    def test_threaded_mode(self):
+        port = self._start('threaded')
+        self._assert_keep_alive(port)
+        self._assert_slow_request_does_not_block(port)
+
+    def test_asyncio_mode(self):
+        port = self._start('asyncio')
+        self._assert_keep_alive(port)
+        self._assert_slow_request_does_not_block(port)
+
+    def test_messages_cursor_headers(self):
+        second_id = self.database.add_message("Second message", "test_repo")
+        port = self._start('threaded')
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        try:
+            conn.request('GET', '/messages?limit=1')
+            response = conn.getresponse()
+            self.assertEqual([msg['content'] for msg in json.loads(response.read())], ["Second message"])
+            self.assertEqual(response.getheader('X-Next-Cursor'), str(second_id))
+            self.assertEqual(response.getheader('X-Prev-Cursor'), str(second_id))
+
+            conn.request('GET', f'/messages?since_id={second_id}')
+            response = conn.getresponse()
+            self.assertEqual(json.loads(response.read()), [])
+            self.assertEqual(response.getheader('X-Next-Cursor'), str(second_id))
+
+            conn.request('GET', '/messages?since_id=abc')
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 400)
+        finally:
+            conn.close()
+
+    def test_messages_filters(self):
+        self.database.add_message("Other repository", "other_repo")
+        port = self._start('threaded')
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        try:
+            conn.request('GET', '/messages?repository=test_repo&limit=10')
+            response = conn.getresponse()
+            self.assertEqual([msg['content'] for msg in json.loads(response.read())], ["Existing message"])
+            self.assertIsNone(response.getheader('X-Prev-Cursor'))
+
+            conn.request('GET', '/messages?start=2000-01-01T00:00:00Z&end=2000-01-02')
+            response = conn.getresponse()
+            self.assertEqual(json.loads(response.read()), [])
+
+            conn.request('GET', '/messages?start=2000-01-01&repository=other_repo')
+            response = conn.getresponse()
+            self.assertEqual([msg['content'] for msg in json.loads(response.read())], ["Other repository"])
+
+            conn.request('GET', '/messages?start=yesterday')
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 400)
+        finally:
+            conn.close()
+
+    def _install_hub(self):
+        hub = chat_server.BroadcastHub(self.database.get_latest_id())
+        listeners = list(self.database._listeners)
+        self.database.add_listener(hub.publish)
+        hub_patch = patch.object(chat_server.MessageHandler, 'hub', hub)
+        hub_patch.start()
+        def restore():
+            hub.close()
+            hub_patch.stop()
+            self.database._listeners[:] = listeners
+        self.addCleanup(restore)
+        return hub
+
+    def test_stream_resumes_from_last_event_id(self):
+        first_id = self.database.get_latest_id()
+        self._install_hub()
+        port = self._start('threaded')
+
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        conn.request('GET', '/messages/stream', headers={'Last-Event-ID': str(first_id - 1)})
+        response = conn.getresponse()
+        self.assertEqual(response.getheader('Content-type'), 'text/event-stream')
+        self.assertEqual(response.readline(), b'retry: 3000\n')
+        response.readline()
+        # The backlog after the cursor comes first, then live messages
+        self.assertEqual(response.readline(), f'id: {first_id}\n'.encode())
+        self.assertIn(b'Existing message', response.readline())
+        response.readline()
+        new_id = self.database.add_message("Live message", "test_repo")
+        self.assertEqual(response.readline(), f'id: {new_id}\n'.encode())
+        self.assertIn(b'Live message', response.readline())
+        conn.close()
+
+    def test_long_poll_returns_new_messages(self):
+        latest_id = self.database.get_latest_id()
+        self._install_hub()
+        port = self._start('threaded')
+
+        threading.Timer(0.1, self.database.add_message, args=("Polled message", "test_repo")).start()
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        conn.request('GET', f'/messages/poll?since_id={latest_id}&timeout=5')
+        response = conn.getresponse()
+        messages = json.loads(response.read())
+        conn.close()
+        self.assertEqual([msg['content'] for msg in messages], ["Polled message"])
+        self.assertEqual(response.getheader('X-Next-Cursor'), str(messages[0]['id']))
+
+    def test_long_polls_leave_workers_free(self):
+        latest_id = self.database.get_latest_id()
+        self._install_hub()
+        slots_patch = patch.object(chat_server.MessageHandler, 'poll_slots', threading.BoundedSemaphore(1))
+        slots_patch.start()
+        self.addCleanup(slots_patch.stop)
+        port = self._start('threaded')
+
+        waiting = http.client.HTTPConnection('localhost', port, timeout=5)
+        self.addCleanup(waiting.close)
+        waiting.request('GET', f'/messages/poll?since_id={latest_id}&timeout=3')
+        time.sleep(0.2)
+        # The only slot is taken: the next poll is turned away at once
+        started = time.monotonic()
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        conn.request('GET', f'/messages/poll?since_id={latest_id}&timeout=3')
+        response = conn.getresponse()
+        response.read()
+        self.assertEqual(response.status, 503)
+        # One that has messages to return needs no slot
+        conn.request('GET', f'/messages/poll?since_id={latest_id - 1}&timeout=3')
+        response = conn.getresponse()
+        self.assertEqual(len(json.loads(response.read())), 1)
+        conn.close()
+        self.assertLess(time.monotonic() - started, 1)
+
+        self.database.add_message("Polled message", "test_repo")
+        response = waiting.getresponse()
+        self.assertEqual([msg['content'] for msg in json.loads(response.read())], ["Polled message"])
+
+    def test_batch_endpoint(self):
+        port = self._start('threaded')
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        try:
+            conn.request('POST', '/messages/batch', body=json.dumps([
+                {'content': 'Imported 1', 'repository': 'test_repo'},
+                {'content': 'Imported 2'}
+            ]))
+            response = conn.getresponse()
+            result = json.loads(response.read())
+            self.assertEqual(response.status, 201)
+            self.assertEqual(result['count'], 2)
+
+            ndjson = '{"content": "Imported 3"}\n{"content": "Imported 4"}\n'
+            conn.request('POST', '/messages/batch', body=ndjson,
+                         headers={'Content-Type': 'application/x-ndjson'})
+            response = conn.getresponse()
+            self.assertEqual(json.loads(response.read())['count'], 2)
+
+            # One bad item rejects the whole batch
+            conn.request('POST', '/messages/batch', body=json.dumps([{'content': 'ok'}, {'text': 'bad'}]))
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 400)
+
+            conn.request('POST', '/messages/batch', body=json.dumps([{'content': 'x', 'repository': {}}]))
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 400)
+
+            for payload in ({'content': {'x': 1}}, {'content': None}, {'content': 'x', 'repository': 1}):
+                conn.request('POST', '/messages', body=json.dumps(payload))
+                response = conn.getresponse()
+                response.read()
+                self.assertEqual(response.status, 400)
+        finally:
+            conn.close()
+        contents = [msg['content'] for msg in self.database.get_messages()]
+        self.assertEqual(contents, ["Existing message", "Imported 1", "Imported 2", "Imported 3", "Imported 4"])
+
+    def test_idempotent_posts(self):
+        keys_patch = patch.object(chat_server.MessageHandler, 'idempotency_keys', chat_server.IdempotencyCache())
+        keys_patch.start()
+        self.addCleanup(keys_patch.stop)
+        port = self._start('threaded')
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+
+        def post(path, payload, key):
+            conn.request('POST', path, body=json.dumps(payload), headers={'Idempotency-Key': key})
+            response = conn.getresponse()
+            body = response.read()
+            return response.status, json.loads(body) if response.status == 201 else None
+        try:
+            status, first = post('/messages', {'content': 'Slow response', 'repository': 'test_repo'}, 'abc')
+            self.assertEqual(status, 201)
+            # The retry is answered from the cache without touching the database
+            with patch.object(self.database, 'add_message') as add_message:
+                status, retry = post('/messages', {'content': 'Slow response', 'repository': 'test_repo'}, 'abc')
+            add_message.assert_not_called()
+            self.assertEqual((status, retry['id']), (201, first['id']))
+
+            # A field works as well as the header, and is checked against the database
+            chat_server.MessageHandler.idempotency_keys = chat_server.IdempotencyCache()
+            conn.request('POST', '/messages', body=json.dumps({'content': 'Slow response', 'idempotency_key': 'abc'}))
+            response = conn.getresponse()
+            self.assertEqual(json.loads(response.read())['id'], first['id'])
+
+            batch = [{'content': 'Batch 1'}, {'content': 'Batch 2'}]
+            _, first_batch = post('/messages/batch', batch, 'batch-1')
+            _, retried_batch = post('/messages/batch', batch, 'batch-1')
+            self.assertEqual(retried_batch['ids'], first_batch['ids'])
+
+            status, _ = post('/messages', {'content': 'Too long'}, 'x' * 256)
+            self.assertEqual(status, 400)
+        finally:
+            conn.close()
+        contents = [msg['content'] for msg in self.database.get_messages()]
+        self.assertEqual(contents, ["Existing message", "Slow response", "Batch 1", "Batch 2"])
+
+    def test_gzip_etag_is_stable(self):
+        # Uncached, so every request compresses the page again
+        cache_patch = patch.object(chat_server.MessageHandler, 'response_cache', None)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+        for i in range(20):
+            self.database.add_message(f"Message {i} " + "x" * 100, "test_repo")
+        port = self._start('threaded')
+
+        etags = set()
+        for clock in (1000.0, 2000.0):
+            # gzip stamps its header with the current time
+            with patch('gzip.time', Mock(time=Mock(return_value=clock))):
+                conn = http.client.HTTPConnection('localhost', port, timeout=5)
+                conn.request('GET', '/messages', headers={'Accept-Encoding': 'gzip'})
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+            self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+            etags.add(response.getheader('ETag'))
+        self.assertEqual(len(etags), 1)
+
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        conn.request('GET', '/messages')
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        # The identity representation has its own ETag
+        self.assertNotIn(response.getheader('ETag'), etags)
+
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        conn.request('GET', '/messages', headers={'Accept-Encoding': 'gzip;q=0'})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        self.assertIsNone(response.getheader('Content-Encoding'))
+
+    def test_messages_response_cache(self):
+        cache = chat_server.ResponseCache()
+        cache_patch = patch.object(chat_server.MessageHandler, 'response_cache', cache)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+        port = self._start('threaded')
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        try:
+            conn.request('GET', '/messages')
+            response = conn.getresponse()
+            response.read()
+            etag = response.getheader('ETag')
+            self.assertIsNotNone(etag)
+
+            # An unchanged history revalidates with 304 straight from the cache
+            with patch.object(chat_server.Database, 'get_messages') as mock_get_messages:
+                conn.request('GET', '/messages', headers={'If-None-Match': etag})
+                response = conn.getresponse()
+                self.assertEqual(response.read(), b'')
+                self.assertEqual(response.status, 304)
+                mock_get_messages.assert_not_called()
+            self.assertEqual(cache.hits, 1)
+
+            # A write bumps the version and invalidates the cached page
+            self.database.add_message("New message", "test_repo")
+            conn.request('GET', '/messages', headers={'If-None-Match': etag, 'Accept-Encoding': 'gzip'})
+            response = conn.getresponse()
+            body = response.read()
+            self.assertEqual(response.status, 200)
+            self.assertNotEqual(response.getheader('ETag'), etag)
+            self.assertEqual(json.loads(body)[-1]['content'], "New message")
+
+            # Paginated variants are cached under their own keys
+            for _ in range(2):
+                conn.request('GET', '/messages?limit=1&since_id=0')
+                response = conn.getresponse()
+                self.assertEqual(json.loads(response.read())[0]['content'], "Existing message")
+            self.assertEqual(cache.hits, 2)
+        finally:
+            conn.close()
+
+    def test_streaming_json_and_ndjson(self):
+        self.database.add_messages([(f"Bulk {i}", "test_repo") for i in range(3)])
+        port = self._start('threaded')
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        try:
+            conn.request('GET', '/messages?stream=1')
+            response = conn.getresponse()
+            self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+            messages = json.loads(response.read())
+            self.assertEqual(len(messages), 4)
+            self.assertEqual(messages, self.database.get_messages())
+
+            # The connection is reusable after the terminating chunk
+            conn.request('GET', f"/messages?format=ndjson&since_id={messages[1]['id']}")
+            response = conn.getresponse()
+            self.assertEqual(response.getheader('Content-type'), 'application/x-ndjson')
+            lines = response.read().decode().splitlines()
+            self.assertEqual([json.loads(line)['content'] for line in lines], ["Bulk 1", "Bulk 2"])
+        finally:
+            conn.close()
+
+    def test_search_endpoint(self):
+        port = self._start('threaded')
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        try:
+            conn.request('GET', '/messages/search?q=existing&repository=test_repo&limit=1')
+            response = conn.getresponse()
+            results = json.loads(response.read())
+            self.assertEqual([msg['content'] for msg in results], ["Existing message"])
+            self.assertEqual(response.getheader('X-Next-Offset'), '1')
+
+            conn.request('GET', '/messages/search?q=')
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 400)
+        finally:
+            conn.close()
+
+    def test_stream_writer_chunks(self):
+        wfile = io.BytesIO()
+        out = chat_server._StreamWriter(wfile, chunked=True, buffer_size=4)
+        out.write('ab')
+        out.write('cde')
+        out.write('f')
+        out.close()
+        self.assertEqual(wfile.getvalue(), b'5\r\nabcde\r\n1\r\nf\r\n0\r\n\r\n')
+
+    def test_response_cache_bounds(self):
+        cache = chat_server.ResponseCache(max_entries=2, max_bytes=100)
+        cache.put(1, 'a', (b'x' * 10, {}))
+        cache.put(1, 'b', (b'x' * 10, {}))
+        cache.get(1, 'a')
+        cache.put(1, 'c', (b'x' * 10, {}))
+        # 'b' was least recently used
+        self.assertIsNone(cache.get(1, 'b'))
+        self.assertIsNotNone(cache.get(1, 'a'))
+        # Oversized bodies are never stored
+        cache.put(1, 'd', (b'x' * 50, {}))
+        self.assertIsNone(cache.get(1, 'd'))
+        # A new version drops everything
+        self.assertIsNone(cache.get(2, 'a'))
+        self.assertEqual(cache.size, 0)
+
+    def test_archive_endpoint(self):
+        self.database.add_message("Second message", "test_repo")
+        self.database.mark_synced([1, 2])
+        self.database.archive_messages(3, '9999-12-31', batch_size=1)
+        self.database.archive_messages(3, '9999-12-31', batch_size=1)
+        port = self._start('threaded')
+        conn = http.client.HTTPConnection('localhost', port, timeout=5)
+        try:
+            conn.request('GET', '/messages/archive?limit=1')
+            response = conn.getresponse()
+            self.assertEqual([msg['content'] for msg in json.loads(response.read())], ["Second message"])
+            self.assertEqual(response.getheader('X-Prev-Cursor'), '2')
+
+            conn.request('GET', '/messages/archive?before_id=2')
+            response = conn.getresponse()
+            self.assertEqual([msg['content'] for msg in json.loads(response.read())], ["Existing message"])
+            self.assertIsNone(response.getheader('X-Prev-Cursor'))
+
+            # Archived messages have left the hot view
+            conn.request('GET', '/messages')
+            self.assertEqual(json.loads(conn.getresponse().read()), [])
+        finally:
+            conn.close()
+
+    def test_metrics_endpoint(self):
+        port = self._start('threaded')
+        not_found = chat_server.HTTP_RESPONSES.value('GET', 'other', '404')
+        with patch.object(chat_server.SYNC_QUEUE_DEPTH, 'callback', self.database.count_pending_sync):
+            conn = http.client.HTTPConnection('localhost', port, timeout=5)
+            try:
+                conn.request('GET', '/messages/1/sync')
+                conn.getresponse().read()
+                conn.request('GET', '/nowhere')
+                conn.getresponse().read()
+                # Requests are recorded just after their response is sent
+                deadline = time.monotonic() + 5
+                while chat_server.HTTP_RESPONSES.value('GET', 'other', '404') == not_found:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.01)
+                conn.request('GET', '/metrics')
+                response = conn.getresponse()
+                body = response.read().decode()
+            finally:
+                conn.close()
+
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.getheader('Content-Type').startswith('text/plain'))
+        lines = body.splitlines()
+        # Paths are collapsed onto their routes
+        self.assertIn('chat_http_responses_total{method="GET",route="/messages/<id>/sync",status="200"}',
+                      ' '.join(lines))
+        self.assertTrue(any(line.startswith('chat_http_responses_total{method="GET",route="other",status="404"}')
+                            for line in lines))
+        self.assertTrue(any(line.startswith('chat_http_request_duration_seconds_bucket{method="GET",route="/messages/<id>/sync"')
+                            for line in lines))
+        self.assertTrue(any(line.startswith('chat_sqlite_query_duration_seconds_count{operation="get_sync_status"}')
+                            for line in lines))
+        self.assertIn('chat_sync_queue_depth 1', lines)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            chat_server.create_server(0, 'forking')
+
+class TestMultiProcess(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'messages.db')
+        self.database = chat_server.Database(self.db_path)
+
+    def tearDown(self):
+        self.database.close()
+
+    def test_change_feed_follows_other_connections(self):
+        # A second Database on the same file stands in for another process
+        other = chat_server.Database(self.db_path)
+        self.addCleanup(other.close)
+        feed = chat_server.ChangeFeed(self.database, batch_size=2)
+        received = []
+        feed.add_listener(received.extend)
+        version = self.database.version
+
+        other.add_messages([("one", "r"), ("two", "r"), ("three", "r")])
+        feed.poll()
+        self.assertEqual([msg['content'] for msg in received], ["one", "two", "three"])
+        self.assertGreater(self.database.version, version)
+
+        # Nothing committed since: no query and no notification
+        with patch.object(self.database, 'get_messages') as get_messages:
+            feed.poll()
+        get_messages.assert_not_called()
+        self.assertEqual(len(received), 3)
+
+    def test_single_sync_leader(self):
+        lock_path = self.db_path + '.sync-leader'
+        first = chat_server.SyncLeaderElection(lock_path, lambda: None)
+        second = chat_server.SyncLeaderElection(lock_path, lambda: None)
+        self.addCleanup(second.stop)
+        self.assertTrue(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+        first.stop()
+        self.assertTrue(second.try_acquire())
+
+    def test_follower_hands_push_to_leader(self):
+        # Another process already holds the leader lock
+        leader = chat_server.SyncLeaderElection(self.db_path + '.sync-leader', lambda: None)
+        self.assertTrue(leader.try_acquire())
+        self.addCleanup(leader.stop)
+        self.addCleanup(chat_server.start_services(self.database, workers=4, multiprocess=True))
+        httpd = chat_server.create_server(0, 'threaded', workers=4)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(httpd.shutdown)
+        port = httpd.server_address[1]
+
+        def request(method, path):
+            conn = http.client.HTTPConnection('localhost', port, timeout=5)
+            conn.request(method, path)
+            response = conn.getresponse()
+            body = json.loads(response.read())
+            conn.close()
+            return response.status, body
+
+        self.database.add_message("Waiting", "test_repo")
+        status, body = request('GET', '/sync/status')
+        self.assertEqual(status, 200)
+        self.assertEqual((body['pending'], body['leader']), (1, False))
+
+        # The leader process, on its own connection, serves the request
+        other = chat_server.Database(self.db_path)
+        self.addCleanup(other.close)
+        leader_worker = Mock(database=other)
+        leader_worker.sync.return_value = True
+        listener = chat_server.SyncRequestListener(leader_worker)
+        responses = []
+        with patch.object(chat_server.SyncWorker, 'sync') as sync:
+            client = threading.Thread(target=lambda: responses.append(request('POST', '/push')))
+            client.start()
+            deadline = time.monotonic() + 5
+            while not listener.poll():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.02)
+            client.join(5)
+            sync.assert_not_called()
+        leader_worker.sync.assert_called_once_with(force=True)
+        self.assertEqual(responses, [(200, {'success': True})])
+
+        # Without a leader to serve it the request stays queued
+        with patch.object(chat_server.MessageHandler, 'push_wait_timeout', 0.2):
+            self.assertEqual(request('POST', '/push'), (202, {'success': None}))
+        self.assertEqual(len(self.database.get_open_sync_requests()), 1)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT') and os.path.exists('/proc/self/task'),
+                         'needs SO_REUSEPORT and /proc')
+    def test_prefork_workers_share_port_and_restart(self):
+        port = chat_server.find_free_port()
+        script = (
+            "import sys, chat_server\n"
+            "chat_server.MessageHandler.db_path = sys.argv[1]\n"
+            # Enough threads for every long-poll below to wait in one worker
+            "chat_server.run_prefork(int(sys.argv[2]), 2, workers=32, restart_delay=0.1)\n"
+        )
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)),
+                   GITHUB_API_URL='http://127.0.0.1:1', SYNC_DEBOUNCE='60')
+        supervisor = subprocess.Popen([sys.executable, '-c', script, self.db_path, str(port)],
+                                      env=env, stderr=subprocess.DEVNULL)
+        self.addCleanup(supervisor.wait, 10)
+        self.addCleanup(supervisor.send_signal, signal.SIGTERM)
+
+        def workers():
+            with open(f'/proc/{supervisor.pid}/task/{supervisor.pid}/children') as f:
+                return set(f.read().split())
+
+        def wait_for(condition):
+            deadline = time.monotonic() + 10
+            while not condition():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+
+        def serving():
+            try:
+                socket.create_connection(('localhost', port), timeout=1).close()
+                return len(workers()) == 2
+            except OSError:
+                return False
+        wait_for(serving)
+
+        # Long-pollers spread over both workers all see the new message
+        latest_id = self.database.get_latest_id()
+        results = []
+        def poll():
+            conn = http.client.HTTPConnection('localhost', port, timeout=10)
+            conn.request('GET', f'/messages/poll?since_id={latest_id}&timeout=8')
+            results.append(json.loads(conn.getresponse().read()))
+            conn.close()
+        pollers = [threading.Thread(target=poll) for _ in range(6)]
+        for poller in pollers:
+            poller.start()
+        time.sleep(0.3)
+        self.database.add_message("Across processes", "test_repo")
+        for poller in pollers:
+            poller.join(10)
+        self.assertEqual([[msg['content'] for msg in result] for result in results],
+                         [["Across processes"]] * 6)
+
+        # A killed worker is replaced
+        original = workers()
+        os.kill(int(sorted(original)[0]), signal.SIGKILL)
+        wait_for(lambda: len(workers()) == 2 and workers() != original)
+
+        supervisor.send_signal(signal.SIGTERM)
+        self.assertEqual(supervisor.wait(10), 0)
+
+class TestStaticAssets(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.page = os.path.join(self.temp_dir, 'index.html')
+        with open(self.page, 'w') as f:
+            f.write('<html>' + 'chat ' * 500 + '</html>')
+        self.assets = chat_server.StaticAssetCache({'/': (self.page, 'text/html')}, check_interval=0)
+
+    def tearDown(self):
+        os.unlink(self.page)
+        os.rmdir(self.temp_dir)
+
+    def test_reloads_when_mtime_changes(self):
+        asset = self.assets.get('/')
+        self.assertIs(self.assets.get('/'), asset)
+        self.assertLess(len(asset.variants['gzip'][0]), len(asset.variants[None][0]))
+
+        with open(self.page, 'w') as f:
+            f.write('<html>changed</html>')
+        os.utime(self.page, (asset.mtime + 10, asset.mtime + 10))
+        reloaded = self.assets.get('/')
+        self.assertEqual(reloaded.variants[None][0], b'<html>changed</html>')
+        self.assertNotEqual(reloaded.variants[None][1], asset.variants[None][1])
+
+    def test_negotiate_honours_q_values(self):
+        asset = self.assets.get('/')
+        self.assertEqual(asset.negotiate('gzip, deflate'), 'gzip')
+        self.assertIsNone(asset.negotiate('gzip;q=0'))
+        self.assertIsNone(asset.negotiate('GZIP; q=0.0, identity'))
+        self.assertIsNone(asset.negotiate('*;q=0'))
+        self.assertEqual(asset.negotiate('*'), 'br' if chat_server.brotli is not None else 'gzip')
+        self.assertEqual(asset.negotiate('br;q=0, gzip;q=0.5'), 'gzip')
+        self.assertEqual(asset.negotiate('*;q=0, gzip'), 'gzip')
+        self.assertIsNone(asset.negotiate(''))
+
+    def test_served_compressed_with_revalidation(self):
+        assets_patch = patch.object(chat_server.MessageHandler, 'static_assets', self.assets)
+        assets_patch.start()
+        self.addCleanup(assets_patch.stop)
+        httpd = chat_server.create_server(0, 'threaded', workers=2)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+
+        conn = http.client.HTTPConnection('localhost', httpd.server_address[1], timeout=5)
+        try:
+            conn.request('GET', '/', headers={'Accept-Encoding': 'gzip'})
+            response = conn.getresponse()
+            body = response.read()
+            self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+            self.assertIn(b'chat chat', gzip.decompress(body))
+            etag = response.getheader('ETag')
+            last_modified = response.getheader('Last-Modified')
+
+            conn.request('GET', '/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 304)
+
+            conn.request('GET', '/', headers={'If-Modified-Since': last_modified})
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 304)
+        finally:
+            conn.close()
+
 class TestGitHubIntegration(unittest.TestCase):
     def setUp(self):
         # Mock GitHub API credentials
@@ -152,8 +1685,8 @@ class TestGitHubIntegration(unittest.TestCase):
         self.mock_username = 'test_username'
         self.mock_repo = 'test_repo'
 
-    @patch('requests.put')
-    @patch('requests.get')
+    @patch('requests.Session.put')
+    @patch('requests.Session.get')
     def test_push_messages_to_github(self, mock_get, mock_put):
         # Setup mock responses
         mock_get.return_value = Mock(
@@ -185,7 +1718,7 @@ class TestGitHubIntegration(unittest.TestCase):
         self.assertTrue(result, "Messages should be successfully pushed")
         
         # Verify GitHub API calls
-        mock_get.assert_called_once()
+        mock_get.assert_not_called()
         mock_put.assert_called_once()
 
         # Check the content of the PUT request
@@ -197,6 +1730,48 @@ class TestGitHubIntegration(unittest.TestCase):
         self.assertIn('First test message', decoded_content)
         self.assertIn('Second test message', decoded_content)
 
+    @patch('requests.Session.put')
+    @patch('requests.Session.get')
+    def test_cached_sha_skips_get(self, mock_get, mock_put):
+        mock_put.return_value = Mock(status_code=201, json=lambda: {'content': {'sha': 'sha-1'}})
+        repo_manager = chat_server.RepositoryManager(self.mock_token, self.mock_username, self.mock_repo)
+        messages = [{'content': 'First', 'timestamp': '2025-01-08 19:55:00'}]
+        self.assertTrue(repo_manager.push_messages(messages))
+
+        mock_put.return_value = Mock(status_code=200, json=lambda: {'content': {'sha': 'sha-2'}})
+        messages.append({'content': 'Second', 'timestamp': '2025-01-08 19:56:00'})
+        self.assertTrue(repo_manager.push_messages(messages))
+
+        # The update reused the SHA from the first PUT without reading the file
+        mock_get.assert_not_called()
+        self.assertEqual(json.loads(mock_put.call_args[1]['data'])['sha'], 'sha-1')
+        self.assertEqual(repo_manager.file_shas['chat_messages/2025-01-08.md'], 'sha-2')
+
+    @patch('requests.Session.put')
+    @patch('requests.Session.get')
+    def test_conflict_refreshes_sha_with_conditional_get(self, mock_get, mock_put):
+        mock_put.side_effect = [
+            Mock(status_code=422, text='sha wasn\'t supplied'),
+            Mock(status_code=200, json=lambda: {'content': {'sha': 'sha-2'}}),
+            Mock(status_code=409, text='conflict'),
+            Mock(status_code=200, json=lambda: {'content': {'sha': 'sha-3'}})
+        ]
+        mock_get.side_effect = [
+            Mock(status_code=200, json=lambda: {'sha': 'sha-1'}, headers={'ETag': '"etag-1"'}),
+            Mock(status_code=304, headers={})
+        ]
+        repo_manager = chat_server.RepositoryManager(self.mock_token, self.mock_username, self.mock_repo)
+        messages = [{'content': 'First', 'timestamp': '2025-01-08 19:55:00'}]
+
+        self.assertTrue(repo_manager.push_messages(messages))
+        self.assertEqual(json.loads(mock_put.call_args[1]['data'])['sha'], 'sha-1')
+
+        # A stale SHA triggers a conditional GET; 304 reuses the cached SHA
+        messages.append({'content': 'Second', 'timestamp': '2025-01-08 19:56:00'})
+        self.assertTrue(repo_manager.push_messages(messages))
+        self.assertEqual(mock_get.call_args[1]['headers'], {'If-None-Match': '"etag-1"'})
+        self.assertEqual(json.loads(mock_put.call_args[1]['data'])['sha'], 'sha-1')
+
     def test_message_content_formatting(self):
         # Create a RepositoryManager with mock credentials
         repo_manager = chat_server.RepositoryManager(
@@ -221,7 +1796,7 @@ class TestGitHubIntegration(unittest.TestCase):
             self.assertTrue(content.startswith('# Chat Messages'))
             self.assertIn(message['content'], content)
 
-    @patch('requests.put')
+    @patch('requests.Session.put')
     def test_github_push_error_handling(self, mock_put):
         # Simulate GitHub API error
         mock_put.return_value = Mock(status_code=500)